@@ -1,47 +1,216 @@
 """The backend."""
 
+import os
+import socket
 import time
 import json
-from tornado.websocket import WebSocketClosedError
+from collections import OrderedDict
+from tornado.ioloop import IOLoop, PeriodicCallback
 
-from settings import DEBUG
+from settings import (DEBUG, DB_DROP, MAX_LOADED_TOPICS, MAX_LOADED_MESSAGES,
+                      PRELOAD_TOPICS, TREE_PAGE_SIZE, HEARTBEAT_INTERVAL,
+                      IDLE_TIMEOUT, REAP_TICK, OUTBOUND_HIGH_WATER,
+                      OUTBOUND_GRACE, MAX_FRAME_SIZE, USER_FRAME_LIMIT,
+                      USER_FANOUT_LIMIT, TOPIC_FANOUT_LIMIT, RESUME_GRACE,
+                      PRESENCE_FLUSH_INTERVAL, SEARCH_RESULTS,
+                      TREE_PAGE_DEPTH, TOP_THREADS, BUS_HEARTBEAT_INTERVAL,
+                      BUS_NODE_TIMEOUT)
 import message
 import db
-from models import Topic, User, MessageTree, to_json
+import metrics
+from bus import LocalBus
+from liveness import Liveness
+from outbound import OutboundQueue
+from presence import Presence
+from ratelimit import RateLimiter
+from models import Topic, User, Message, MessageTree, to_json
+from topicindex import TopicIndex
 
 
 class BackEnd(object):
-    def __init__(self):
+    # the bus channel that the server processes share events on
+    BUS_CHANNEL = 'qanda'
 
-        self.db = db.message_database()
+    def __init__(self, bus=None, worker=0, nworkers=1, drop=DB_DROP):
+        """bus connects this process to the other worker processes (if
+        any), and worker is the number of this process out of nworkers.
+        """
+
+        self.db = db.message_database(drop)
+        # new ids come from the db, so that they are unique across
+        # restarts and across the worker processes
+        User.ids = self.db.id_allocator('users', worker, nworkers)
+        Topic.ids = self.db.id_allocator('topics', worker, nworkers)
+        Message.ids = self.db.id_allocator('messages', worker, nworkers)
         # userids as keys, user objects as values
         self.users = {}
+        # userids of the users whose connection has closed, as keys,
+        # and the timeouts that will remove them, as values (see
+        # detach_user)
+        self._detached = {}
         # topicids as keys, topic objects as values
         self.topics = {}
-        # load all existing topics and their messages
+        # topic names as keys, topic objects as values
+        self.topic_names = {}
+        # incremented whenever a topic is added, and the time it was
+        # last incremented
+        self.topics_version = 0
+        self.topics_modified = time.time()
+        # ids of the topics whose message trees are in memory, least
+        # recently used first (the values are unused)
+        self._loaded = OrderedDict()
+        # the number of messages in them
+        self._nloaded_messages = 0
+        # load all existing topics; their messages are only loaded when
+        # the topic is first visited (see load_topic)
         topics = self.db.get_all_topics()
+        # for searching and paging through the topics
+        self.topic_index = TopicIndex()
+        counts = self.db.get_message_counts()
+        last_posts = self.db.get_last_post_times()
         for t in topics:
-            t.message_tree = MessageTree(self.db.get_all_messages_for_topic(t.id))
+            t.message_tree = None
             self.topics[t.id] = t
+            self.topic_names[t.name] = t
+            self.topic_index.add(t, counts.get(t.id, 0),
+                                 last_posts.get(t.id, 0))
+        # except for the newest few, which we load straight away
+        self.load_topics(sorted(self.topics)[-PRELOAD_TOPICS:]
+                         if PRELOAD_TOPICS > 0 else [])
+
+        # events from the other processes, by event name
+        self._remote_events = {'hello': self._remote_hello,
+                               'beat': self._remote_beat,
+                               'topic': self._remote_topic,
+                               'message': self._remote_message,
+                               'join': self._remote_join,
+                               'leave': self._remote_leave,
+                               'handle': self._remote_handle}
+        self.nodeid = '{0}:{1}'.format(socket.gethostname(), os.getpid())
+        # nodeids of the other processes as keys, and when we last heard
+        # from them as values, and the (topicid, userid) of each user in
+        # the topics' remote_users, by the nodeid of its process
+        self._nodes = {}
+        self._node_users = {}
+        # the other processes that we have stopped hearing from
+        self._lost_nodes = set()
+        self._last_beat = time.time()
+        self.bus = LocalBus() if bus is None else bus
+        self.bus.subscribe(self.BUS_CHANNEL, self._on_bus_event)
+        # ask the other processes to tell us who is connected to them
+        self.publish('hello')
+
+        # connections that miss two heartbeats count as stale, and
+        # those idle for IDLE_TIMEOUT are closed
+        self.liveness = Liveness(IDLE_TIMEOUT, REAP_TICK,
+                                 2 * HEARTBEAT_INTERVAL, self._reap_user)
+        self._reaper = PeriodicCallback(self._tick, REAP_TICK * 1000)
+        self._reaper.start()
+
+        # arrivals and departures are sent to each topic in batches
+        self.presence = Presence(self, PRESENCE_FLUSH_INTERVAL)
+        self.presence.start()
+
+        # limits on the frames a user can send, and on the messages
+        # that are sent on to everyone in a topic (by user and by topic)
+        self._frame_limit = RateLimiter('user_frames', *USER_FRAME_LIMIT)
+        self._user_fanout_limit = RateLimiter('user_fanout',
+                                              *USER_FANOUT_LIMIT)
+        self._topic_fanout_limit = RateLimiter('topic_fanout',
+                                               *TOPIC_FANOUT_LIMIT)
 
     def add_topic(self, name):
         """Return True if successfully added topic."""
 
-        for t in self.topics.values():
-            if (t.name == name):
-                return False
+        if name in self.topic_names:
+            return False
         newt = Topic(name)
-        self.topics[newt.id] = newt
+        self._add_topic(newt)
         # add to db
         self.db.add_topic(newt)
+        self.publish('topic', id=newt.id, name=newt.name)
         return True
 
+    def _add_topic(self, t):
+        # a new topic has no messages to load
+        self.topics[t.id] = t
+        self.topic_names[t.name] = t
+        self.topic_index.add(t)
+        self.topics_version += 1
+        self.topics_modified = time.time()
+        self._loaded[t.id] = None
+        self._evict_topics(keep=(t.id,))
+
     def get_topic_from_id(self, topicid):
         if topicid in self.topics:
             return self.topics[topicid]
         return None
 
-    def set_topic_for_user(self, userid, topicid):
+    def load_topic(self, topicid):
+        """Return the topic with its message tree in memory, or None."""
+
+        t = self.topics.get(topicid)
+        if t is None:
+            return None
+        if t.message_tree is None:
+            start = time.time()
+            t.message_tree = MessageTree(
+                self.db.get_all_messages_for_topic(topicid))
+            self._nloaded_messages += len(t.message_tree)
+            metrics.observe('topic_load', time.time() - start)
+        else:
+            # mark as most recently used
+            del self._loaded[topicid]
+        self._loaded[topicid] = None
+        self._evict_topics(keep=(topicid,))
+        return t
+
+    def load_topics(self, topicids):
+        """Load the message trees of all the topics in topicids that are
+        not already in memory, in a single db query.  None of the topics
+        in topicids are unloaded to make room."""
+
+        topicids = set(topicids)
+        toload = [tid for tid in topicids
+                  if self.topics[tid].message_tree is None]
+        if not toload:
+            return
+        start = time.time()
+        messages = self.db.get_messages_for_topics(toload)
+        for tid in toload:
+            self.topics[tid].message_tree = MessageTree(messages[tid])
+            # not len(messages[tid]), which counts any orphans
+            self._nloaded_messages += len(self.topics[tid].message_tree)
+            self._loaded[tid] = None
+        metrics.observe('topic_load', time.time() - start)
+        self._evict_topics(keep=topicids)
+
+    def add_message(self, t, mnode):
+        """Add mnode to the loaded topic t, and return the list of
+        messages added (see MessageTree.add_message)."""
+
+        added = t.add_message(mnode)
+        self._nloaded_messages += len(added)
+        return added
+
+    def _evict_topics(self, keep=()):
+        """Unload idle topics, least recently used first, until we are
+        within MAX_LOADED_TOPICS and MAX_LOADED_MESSAGES.  The topics in
+        keep, which the caller has just loaded, are not unloaded."""
+
+        for tid in self._loaded.keys():
+            if (len(self._loaded) <= MAX_LOADED_TOPICS and
+                self._nloaded_messages <= MAX_LOADED_MESSAGES):
+                break
+            t = self.topics[tid]
+            # never unload a topic that somebody is looking at
+            if t.nusers == 0 and tid not in keep:
+                self._nloaded_messages -= len(t.message_tree)
+                t.unload()
+                del self._loaded[tid]
+                metrics.incr('topic_evictions')
+
+    def set_topic_for_user(self, userid, topicid, since=None):
         try:
             u = self.users[userid]
         except KeyError:
@@ -49,73 +218,439 @@ class BackEnd(object):
             pass
         else:
             u.topicid = topicid
-            t = self.topics[topicid]
-            t.add_user(userid)
-            # send all other handles to user
-            for uid in self.topics[topicid].users:
-                if uid != userid:
-                    user = self.users[uid]
-                    self.send_message({message.K_TYPE: message.M_NEWHANDLE,
-                                       'handle': user.handle,
-                                       'userid': uid}, userid)
-
-            # send all messages in topic message tree to client
-            self.send_message({message.K_TYPE: message.M_FULLTREE,
-                               'tree': t.get_all_messages()},
+            t = self.load_topic(topicid)
+            t.add_user(u)
+            # tell the user who else is here
+            self.send_message({message.K_TYPE: message.M_ROSTER,
+                               'roster': self.presence.roster(t, userid)},
                               userid)
 
-            # send new handle to all the other clients on this topic
-            for uid in self.topics[topicid].users:
-                if uid != userid:
-                    self.send_message({message.K_TYPE: message.M_NEWHANDLE,
-                                       'handle': u.handle,
-                                       'userid': userid}, uid)
+            # send the messages the client missed if it is reconnecting,
+            # otherwise the newest threads in the topic
+            missed = None
+            if since is not None:
+                missed = t.get_messages_since(since)
+            if missed is not None:
+                self.send_message({message.K_TYPE: message.M_MISSED,
+                                   'messages': missed}, userid)
+            else:
+                self.send_tree_page(userid)
+
+            # and tell the other users, in the next presence message
+            self.presence.joined(topicid, userid, u.handle)
+            self.publish('join', topicid=topicid, userid=userid,
+                         handle=u.handle)
+
+    def send_tree_page(self, userid, before=None):
+        """Send the user the page of threads older than the root message
+        before, or the newest page if before is None."""
+
+        u = self.users[userid]
+        t = self.load_topic(u.topicid)
+        if t is None:
+            return
+        if before is None:
+            self._write(u, self._get_snapshot(t, u.encoding))
+        else:
+            self.send_message({message.K_TYPE: message.M_TREEPAGE,
+                               'tree': t.get_page(before, TREE_PAGE_SIZE,
+                                                  TREE_PAGE_DEPTH),
+                               'before': before}, userid)
+
+    def send_thread(self, userid, msgid):
+        """Send the user the replies below the message msgid, going
+        TREE_PAGE_DEPTH levels down (the user asks for the rest as it
+        needs them)."""
+
+        u = self.users[userid]
+        t = self.load_topic(u.topicid)
+        if t is None:
+            return
+        subtree = t.message_tree.get_subtree(msgid, TREE_PAGE_DEPTH)
+        if subtree is not None:
+            self.send_message({message.K_TYPE: message.M_THREADTREE,
+                               'id': msgid, 'tree': subtree}, userid)
+
+    def send_top_threads(self, userid, by, k=TOP_THREADS):
+        """Send the user summaries of the top k threads in its topic,
+        in the order by (one of MessageTree.ORDERS)."""
+
+        u = self.users[userid]
+        t = self.load_topic(u.topicid)
+        if t is None or by not in MessageTree.ORDERS:
+            return
+        self.send_message({message.K_TYPE: message.M_THREADLIST, 'by': by,
+                           'threads': t.message_tree.top_threads(k, by)},
+                          userid)
+
+    def _get_snapshot(self, t, encoding):
+        """Return the page of newest threads for topic t, as a frame in
+        the wire encoding.
+
+        Every user joining the topic gets the same page, so we only
+        encode it again when the message tree has changed (the page
+        keeps the timestamp of when it was encoded).
+        """
+
+        version = t.message_tree.version
+        if t.snapshot_version != version:
+            t.snapshot = {}
+            t.snapshot_version = version
+        frame = t.snapshot.get(encoding)
+        if frame is not None:
+            metrics.incr('snapshot_hits')
+            return frame
+
+        metrics.incr('snapshot_misses')
+        start = time.time()
+        frame = t.snapshot[encoding] = message.encode(
+            {message.K_TYPE: message.M_TREEPAGE,
+             'tree': t.get_page(None, TREE_PAGE_SIZE, TREE_PAGE_DEPTH),
+             'before': None,
+             message.K_TSTAMP: time.time()*1000}, encoding)
+        metrics.observe('snapshot_rebuild', time.time() - start)
+        return frame
 
     def get_topics(self):
         return self.topics.values()
+
+    def search(self, query, topicid=None, limit=SEARCH_RESULTS):
+        """Return the best limit messages that contain all the words in
+        query, from the topic topicid (or from all topics if None), best
+        first.  Each result is a dict with the message, its topicid, and
+        its thread: the messages from the root of the thread down to its
+        parent.
+
+        A topic is searched using its message tree, and all topics using
+        the db, which doesn't need them all in memory.
+        """
+
+        if topicid is not None:
+            t = self.load_topic(topicid)
+            if t is None:
+                return []
+            with metrics.timer('search', {'scope': 'topic'}):
+                return [{'topicid': topicid, 'message': mnode,
+                         'thread': t.message_tree.get_thread(mnode.id)}
+                        for (score, mnode) in t.message_tree.search(query,
+                                                                    limit)]
+
+        with metrics.timer('search', {'scope': 'all'}):
+            found = [(tid, mid) for (tid, mid)
+                     in self.db.search_messages(query, None, limit)
+                     if tid in self.topics]
+            # the threads come from the message trees
+            self.load_topics(set(tid for (tid, mid) in found))
+            results = []
+            for (tid, mid) in found:
+                tree = self.topics[tid].message_tree
+                mnode = tree.get_message(mid) if tree is not None else None
+                if mnode is not None:
+                    results.append({'topicid': tid, 'message': mnode,
+                                    'thread': tree.get_thread(mid)})
+            return results
+
+    def close(self):
+        """Called when the server shuts down."""
+        self._reaper.stop()
+        self.presence.stop()
+        self.db.close()
+        self.bus.close()
+
+    def publish(self, event, **data):
+        """Tell the other server processes about event."""
+        data['event'] = event
+        data['origin'] = self.nodeid
+        self.bus.publish(self.BUS_CHANNEL, json.dumps(data, default=to_json))
+
+    def _on_bus_event(self, data):
+        data = json.loads(data)
+        # we hear our own events too
+        origin = data['origin']
+        if origin == self.nodeid:
+            return
+        self._nodes[origin] = time.time()
+        if origin in self._lost_nodes:
+            # it is back, but we have forgotten its users
+            self._lost_nodes.discard(origin)
+            self.publish('hello', to=origin)
+        self._remote_events[data['event']](data)
+
+    def _check_nodes(self, now):
+        """Tell the other processes we are alive, if it is time to, and
+        take the users of any process we have not heard from in
+        BUS_NODE_TIMEOUT seconds out of their topics."""
+
+        if now - self._last_beat >= BUS_HEARTBEAT_INTERVAL:
+            self._last_beat = now
+            self.publish('beat')
+        for (nodeid, heard) in self._nodes.items():
+            if now - heard > BUS_NODE_TIMEOUT:
+                del self._nodes[nodeid]
+                self._lost_nodes.add(nodeid)
+                metrics.incr('bus_nodes_lost')
+                for (topicid, userid) in self._node_users.pop(nodeid, ()):
+                    t = self.topics.get(topicid)
+                    if t is not None and t.remote_users.pop(userid, None):
+                        self.presence.left(topicid, userid)
+
+    def _remote_hello(self, data):
+        # a new process has started (or one has lost track of us), tell
+        # it about all our users
+        if data.get('to', self.nodeid) != self.nodeid:
+            return
+        for u in self.users.values():
+            if u.topicid in self.topics:
+                self.publish('join', topicid=u.topicid, userid=u.userid,
+                             handle=u.handle)
+
+    def _remote_beat(self, data):
+        # hearing it is enough (see _on_bus_event)
+        pass
+
+    def _remote_topic(self, data):
+        if data['id'] not in self.topics:
+            self._add_topic(Topic(data['name'], data['id']))
+
+    def _remote_message(self, data):
+        m = data['message']
+        mnode = Message(m['user'], m['message'], m['parentid'],
+                        m['posttime'], m['topicid'], m['id'])
+        self.topic_index.message_added(mnode.topicid, mnode.timestamp)
+        t = self.topics.get(mnode.topicid)
+        # if the topic isn't loaded, the message is read from the db
+        # along with the others when it is
+        if t is not None and t.message_tree is not None:
+            # a reply can come before its parent, in which case the tree
+            # holds it back until the parent comes
+            for added in self.add_message(t, mnode):
+                self.broadcast(t.id, {message.K_TYPE: message.M_NEWMESSAGE,
+                                      'message': added})
+
+    def _remote_join(self, data):
+        t = self.topics.get(data['topicid'])
+        if t is not None:
+            t.remote_users[data['userid']] = data['handle']
+            self._node_users.setdefault(data['origin'], set()).add(
+                (t.id, data['userid']))
+            self.presence.joined(t.id, data['userid'], data['handle'])
+
+    def _remote_leave(self, data):
+        t = self.topics.get(data['topicid'])
+        self._node_users.get(data['origin'], set()).discard(
+            (data['topicid'], data['userid']))
+        if t is not None and t.remote_users.pop(data['userid'], None):
+            self.presence.left(t.id, data['userid'])
+
+    def _remote_handle(self, data):
+        t = self.topics.get(data['topicid'])
+        if t is not None and data['userid'] in t.remote_users:
+            t.remote_users[data['userid']] = data['handle']
+            self.presence.renamed(t.id, data['userid'], data['handle'])
+            self.broadcast(t.id, {message.K_TYPE: message.M_CHANGEHANDLE,
+                                  'changeid': data['userid'],
+                                  'newhandle': data['handle']},
+                           key=(message.M_CHANGEHANDLE, data['userid']))
         
-    def add_user(self, handler):
+    def add_user(self, handler, userid=None, auth_token=None, since=None):
         """handler is an instance of tornado.websocket.WebSocketHandler.
 
         We can send a message to the user by calling handler.write_message
+
+        If the client was connected before, it gives its userid and
+        auth_token, and the id of the last message it received as
+        since, and we resume its session if we still have it.
         """
 
+        if userid is not None and self.resume_user(handler, userid,
+                                                   auth_token, since):
+            return
+
         u = User()
-        u._handler = handler
         self.users[u.userid] = u
+        self._attach(u, handler)
 
         # send handle to user along with user id
         self.send_message({message.K_TYPE: message.M_MYHANDLE,
                            'handle': u.handle, 'userid': u.userid,
                            'auth_token': u.auth_token}, u.userid)
 
-    def remove_user(self, handler):
-        # not ideal (probably)
-        closeid = None
-        for (uid, u) in self.users.items():
-            if (u._handler == handler):
-                print "id closed is {}".format(uid)
-                closeid = uid
-                break
+    def _attach(self, u, handler):
+        u._handler = handler
+        u.encoding = getattr(handler, 'encoding', message.ENC_JSON)
+        u.outbound = OutboundQueue(handler, OUTBOUND_HIGH_WATER,
+                                   OUTBOUND_GRACE,
+                                   lambda: self._drop_slow_user(u.userid))
+        # the handler remembers its user, so that we can find the user
+        # again without searching when the connection is closed
+        handler.userid = u.userid
+        self.liveness.add(u.userid)
 
-        if closeid is not None:
-            u = self.users[closeid]
-            for uid in self.topics[u.topicid].users:
-                if uid != closeid:
-                    self.send_message({message.K_TYPE: message.M_REMOVEHANDLE,
-                                       'userid': closeid},
-                                      uid)
-            self.topics[u.topicid].remove_user(closeid)
-            del self.users[closeid]
-        else:
+    def _release(self, handler):
+        """Separate handler from its user, and return the user (None if
+        handler has no user)."""
+
+        u = self.users.get(getattr(handler, 'userid', None))
+        if u is None or u._handler is not handler:
             if DEBUG:
                 print 'could not find id to close!'
+            return None
+
+        if DEBUG:
+            print "id closed is {}".format(u.userid)
+        handler.userid = None
+        u._handler = None
+        u.outbound.close()
+        self.liveness.remove(u.userid)
+        return u
+
+    def resume_user(self, handler, userid, auth_token, since=None):
+        """Give the session of userid to the new connection handler, and
+        send the user what it missed.  Returns False if the session has
+        gone or auth_token is wrong."""
+
+        u = self.users.get(userid)
+        if (u is None or u.auth_token != auth_token or
+            u.topicid not in self.topics):
+            metrics.incr('sessions_resume_failed')
+            return False
+
+        if u._handler is not None:
+            # the old connection has not noticed that it is dead yet
+            old = u._handler
+            self._release(old)
+            old.close()
+        timeout = self._detached.pop(userid, None)
+        if timeout is not None:
+            IOLoop.current().remove_timeout(timeout)
+        self._attach(u, handler)
+        metrics.incr('sessions_resumed')
+
+        # the other users in the topic never saw us leave, so there is
+        # nothing to tell them; we tell the user who is here now, and
+        # send the messages it missed (or the newest threads if we
+        # don't have its last message)
+        t = self.load_topic(u.topicid)
+        missed = None
+        if since is not None:
+            missed = t.get_messages_since(since)
+        self.send_message({message.K_TYPE: message.M_RESUMED,
+                           'handle': u.handle, 'userid': userid,
+                           'auth_token': u.auth_token,
+                           'roster': self.presence.roster(t, userid),
+                           'messages': missed}, userid)
+        if missed is None:
+            self.send_tree_page(userid)
+        return True
+
+    def detach_user(self, handler):
+        """Called when the connection of a user closes.
+
+        The user stays in its topic for RESUME_GRACE seconds, so that a
+        client that reconnects can carry on (see resume_user) without
+        the other users seeing it leave and join again.
+        """
+
+        u = self._release(handler)
+        if u is None:
+            return
+        if RESUME_GRACE > 0:
+            self._detached[u.userid] = IOLoop.current().add_timeout(
+                time.time() + RESUME_GRACE,
+                lambda: self._remove(u.userid))
+        else:
+            self._remove(u.userid)
+
+    def remove_user(self, handler):
+        """Remove the user on handler straight away."""
+        u = self._release(handler)
+        if u is not None:
+            self._remove(u.userid)
+
+    def _remove(self, closeid):
+        timeout = self._detached.pop(closeid, None)
+        if timeout is not None:
+            IOLoop.current().remove_timeout(timeout)
+        u = self.users.pop(closeid, None)
+        if u is None:
+            return
 
-    def on_message(self, mess):
+        self._frame_limit.forget(closeid)
+        self._user_fanout_limit.forget(closeid)
+        metrics.observe('session_bytes', u.bytes_sent,
+                        buckets=metrics.SIZE_BUCKETS)
+        t = self.topics.get(u.topicid)
+        if t is not None:
+            t.remove_user(closeid)
+            self.presence.left(u.topicid, closeid)
+            self.publish('leave', topicid=u.topicid, userid=closeid)
+            if t.nusers == 0:
+                self._evict_topics()
+
+    def _tick(self):
+        """Called every REAP_TICK seconds."""
+
+        self.liveness.tick()
+        now = time.time()
+        self._check_nodes(now)
+        nframes = nbytes = maxbytes = 0
+        for u in self.users.values():
+            if u._handler is None:
+                continue
+            u.outbound.check(now)
+            nframes += len(u.outbound)
+            nbytes += u.outbound.buffered_bytes
+            maxbytes = max(maxbytes, u.outbound.buffered_bytes)
+        metrics.gauge('outbound_queued_frames', nframes)
+        metrics.gauge('outbound_buffered_bytes', nbytes)
+        metrics.gauge('outbound_max_buffered_bytes', maxbytes)
+
+    def _reap_user(self, userid):
+        """Called for users we have not heard from in IDLE_TIMEOUT seconds."""
+        if DEBUG:
+            print 'reaping idle user {0}'.format(userid)
+        self._disconnect(userid)
+
+    def _drop_slow_user(self, userid):
+        """Called for users that have not read what we sent them for
+        OUTBOUND_GRACE seconds."""
+        if DEBUG:
+            print 'dropping slow user {0}'.format(userid)
+        self._disconnect(userid)
+
+    def _disconnect(self, userid):
+        u = self.users.get(userid)
+        if u is None or u._handler is None:
+            return
+        handler = u._handler
+        # let go of the connection now, rather than when the close
+        # completes (for a half open connection that may take a while);
+        # the client can still resume the session if it comes back
+        self.detach_user(handler)
+        handler.close()
+
+    def on_message(self, handler, mess):
+        """Handle the frame mess received on the websocket handler."""
+
+        # any frame shows the connection is alive; heartbeats need no
+        # more than that
+        self.liveness.touch(handler.userid)
+        if mess == message.HEARTBEAT_FRAME:
+            metrics.incr('heartbeats')
+            return
 
         if DEBUG:
             print 'GOT MESSAGE: {}'.format(mess)
 
+        start = time.time()
+
+        # turn away floods before spending any time decoding them
+        if len(mess) > MAX_FRAME_SIZE:
+            metrics.incr('rejected_oversize')
+            return
+        if not self._frame_limit.allow(handler.userid):
+            return
+
         msg = json.loads(mess)
 
         # check the message has all the required keys
@@ -128,20 +663,70 @@ class BackEnd(object):
                 print 'received incorrect auth_token for client {0}'\
                     .format(uid)
             return
+
+        if msg[message.K_TYPE] in message.FANOUT_MESSAGES:
+            if not (self._user_fanout_limit.allow(uid) and
+                    self._topic_fanout_limit.allow(self.users[uid].topicid)):
+                return
         
         # message ok, execute callback
-        cback = message.CALLBACKS.get(msg[message.K_TYPE], 
-                                      message.message_ignore)
+        mtype = msg[message.K_TYPE]
+        cback = message.CALLBACKS.get(mtype, message.message_ignore)
         cback(self, msg)
+        metrics.observe('on_message', time.time() - start, {'mtype': mtype})
 
     def send_message(self, messagedict, userid):
-        # add timestamp and stringify the message
+        start = time.time()
+        user = self.users[userid]
+        messagedict[message.K_TSTAMP] = start*1000
+        frame = message.encode(messagedict, user.encoding)
+        if DEBUG:
+            print 'SENDING MESSAGE: {}'.format(messagedict)
+        self._write(user, frame)
+        metrics.observe('send_message', time.time() - start,
+                        {'mtype': messagedict[message.K_TYPE]})
+
+    def broadcast(self, topicid, messagedict, exclude=None, key=None):
+        """Send messagedict to every user in the topic except exclude.
+
+        The message is timestamped once, and encoded once for each wire
+        encoding in use, and the same frame is written to every user
+        with that encoding.  If key is given, the message replaces any
+        message with the same key still queued for a user (see
+        outbound.py).  Returns the time taken in seconds.
+        """
+
+        start = time.time()
+        t = self.topics.get(topicid)
+        if t is None:
+            return 0.0
         messagedict[message.K_TSTAMP] = time.time()*1000
-        jsonmsg = json.dumps(messagedict, default=to_json)
+        frames = {}
+        nsent = 0
+        for (uid, user) in t.users.iteritems():
+            if uid != exclude:
+                frame = frames.get(user.encoding)
+                if frame is None:
+                    frame = frames[user.encoding] = \
+                        message.encode(messagedict, user.encoding)
+                self._write(user, frame, key)
+                nsent += 1
+        elapsed = time.time() - start
+        metrics.observe('broadcast', elapsed)
+        metrics.observe('broadcast_fanout', nsent, buckets=metrics.SIZE_BUCKETS)
+        metrics.incr('broadcast_recipients', nsent)
         if DEBUG:
-            print 'SENDING MESSAGE: {}'.format(jsonmsg)
-        
-        try:
-            self.users[userid]._handler.write_message(jsonmsg)
-        except WebSocketClosedError:
-            pass
+            print 'BROADCAST to {0} users in {1:.2f} ms: {2}'\
+                .format(nsent, elapsed*1000, messagedict)
+        return elapsed
+
+    def _write(self, user, frame, key=None):
+        """Queue frame, a (data, binary) pair from message.encode, for user."""
+        if user._handler is None:
+            # detached, the user gets what it missed when it resumes
+            return
+        user.outbound.put(frame, key)
+        nbytes = len(frame[0])
+        user.bytes_sent += nbytes
+        metrics.incr('bytes_sent', nbytes)
+        metrics.incr('bytes_sent_' + user.encoding, nbytes)
@@ -0,0 +1,525 @@
+"""Load generator for the websocket protocol.
+
+Starts server.py (with the dummy or flat file db) and connects many
+simulated clients to one topic.  The clients speak the same protocol as
+the browser: they send connect, wait for myhandle, send settopic, post
+responses and send heartbeats (see message.py).  Scenarios:
+
+join_burst      - everyone joins at once, as at the start of a lecture
+steady_qa       - everyone is joined and a few clients post questions
+                  at a steady rate for a while
+reconnect_storm - everyone is joined, then all the connections drop
+                  and reconnect at once, as after a network blip, and
+                  resume their sessions
+
+The clients are shared between --procs worker processes, since a single
+process can not keep up with thousands of them.  The results (joins/s,
+posts/s, broadcast latency percentiles, memory per connection) are
+printed, and saved as JSON with --out.  Two saved runs can be compared
+with the compare command.
+
+Usage:
+    python benchmarks/loadgen.py run SCENARIO [options]
+    python benchmarks/loadgen.py compare OLD.json NEW.json
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import re
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib
+import zlib
+
+from tornado import gen, ioloop, websocket
+from tornado.httpclient import HTTPClient
+from tornado.iostream import StreamClosedError
+
+_root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, _root)
+
+import message
+from settings import HEARTBEAT_INTERVAL
+
+SCENARIOS = ['join_burst', 'steady_qa', 'reconnect_storm']
+
+# the text of each post starts with an id and the time it was sent
+POST_FORMAT = 'lg{0}@{1!r} load generator question'
+POST_RE = re.compile(r'lg([\d-]+)@([\d.]+) ')
+
+# how long the parent waits for a worker before checking it is alive
+WORKER_POLL = 1.0
+
+LONG_KEYS = dict((short, key) for (key, short) in message.SHORT_KEYS.items())
+
+
+def expand_keys(obj):
+    """Undo message.shorten_keys."""
+
+    if isinstance(obj, dict):
+        return dict((LONG_KEYS.get(k, k), expand_keys(v))
+                    for (k, v) in obj.iteritems())
+    if isinstance(obj, list):
+        return [expand_keys(v) for v in obj]
+    return obj
+
+
+def decode(data, encoding):
+    """Return the message in a frame sent with encoding; binary frames
+    are the ones that tornado does not decode to unicode."""
+
+    if isinstance(data, bytes):
+        data = zlib.decompress(data)
+    msg = json.loads(data)
+    if encoding != message.ENC_JSON:
+        msg = expand_keys(msg)
+    return msg
+
+
+class Client(object):
+    """A simulated browser connected to a topic."""
+
+    def __init__(self, url, encoding, stats):
+        self.url = url
+        self.encoding = encoding
+        self.stats = stats
+        self.conn = None
+        self.userid = None
+        self.auth_token = None
+        # id of the newest message we have, sent as since when resuming
+        self.last_id = None
+
+    @gen.coroutine
+    def join(self, topicid):
+        """Connect and join the topic as a new user; returns once the
+        tree arrives."""
+
+        msg = yield self._connect({})
+        yield self._settopic(msg, topicid)
+
+    @gen.coroutine
+    def resume(self, topicid):
+        """Connect again and resume our session, as the browser does
+        (joining as a new user if the server no longer has it); returns
+        once we have what we missed."""
+
+        msg = yield self._connect({message.K_ID: self.userid,
+                                   message.K_AUTH: self.auth_token,
+                                   'since': self.last_id})
+        if msg[message.K_TYPE] != message.M_RESUMED:
+            yield self._settopic(msg, topicid)
+            return
+        self.stats.resumed += 1
+        if msg['messages']:
+            self.last_id = msg['messages'][-1]['id']
+        elif msg['messages'] is None:
+            # we get the newest threads instead
+            while msg[message.K_TYPE] != message.M_TREEPAGE:
+                msg = yield self._read()
+            self.last_id = msg['tree'].get('last')
+        self._listen()
+
+    @gen.coroutine
+    def _connect(self, args):
+        """Open the connection and send connect with args; returns the
+        server's reply (myhandle, or resumed)."""
+
+        self.conn = yield websocket.websocket_connect(self.url)
+        args[message.K_TYPE] = message.M_CONNECT
+        self.conn.write_message(json.dumps(args))
+        msg = yield self._read()
+        self.userid = msg[message.K_ID]
+        self.auth_token = msg[message.K_AUTH]
+        raise gen.Return(msg)
+
+    @gen.coroutine
+    def _settopic(self, msg, topicid):
+        self.send({message.K_TYPE: message.M_SETTOPIC, 'topicid': topicid})
+        while msg[message.K_TYPE] != message.M_TREEPAGE:
+            msg = yield self._read()
+        self.last_id = msg['tree'].get('last')
+        self._listen()
+
+    def send(self, msg):
+        msg[message.K_ID] = self.userid
+        msg[message.K_AUTH] = self.auth_token
+        self.conn.write_message(json.dumps(msg))
+
+    def heartbeat(self):
+        if self.conn is None:
+            # not connected
+            return
+        try:
+            self.conn.write_message(message.HEARTBEAT_FRAME)
+        except StreamClosedError:
+            pass
+
+    def post(self, topicid, text):
+        self.send({message.K_TYPE: message.M_RESPONSE, 'topicid': topicid,
+                   'text': text, 'replyid': -1})
+
+    def close(self):
+        self.conn.close()
+        self.conn = None
+
+    @gen.coroutine
+    def _read(self):
+        data = yield self.conn.read_message()
+        raise gen.Return(decode(data, self.encoding))
+
+    @gen.coroutine
+    def _listen(self):
+        conn = self.conn
+        while True:
+            data = yield conn.read_message()
+            if data is None:
+                return
+            # only decode the messages we time, so that the clients
+            # don't become the bottleneck
+            if isinstance(data, bytes):
+                data = zlib.decompress(data)
+            if message.M_NEWMESSAGE in data:
+                msg = decode(data, self.encoding)
+                if msg[message.K_TYPE] == message.M_NEWMESSAGE:
+                    self.last_id = msg['message']['id']
+                self.stats.received(msg)
+
+
+class Stats(object):
+    """Posts sent and received by the clients of one worker."""
+
+    def __init__(self):
+        self.sent = 0
+        # sessions resumed after reconnecting
+        self.resumed = 0
+        # ids of the posts that have been received by anyone
+        self.seen = set()
+        # seconds from sending each post to each client receiving it
+        self.latencies = []
+
+    def received(self, msg):
+        if msg[message.K_TYPE] != message.M_NEWMESSAGE:
+            return
+        match = POST_RE.match(msg['message']['message'])
+        if match is not None:
+            self.seen.add(match.group(1))
+            self.latencies.append(time.time() - float(match.group(2)))
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100.0 * len(values)))]
+
+
+def rss(pid):
+    """Return the resident memory of process pid in bytes (Linux only)."""
+    try:
+        with open('/proc/{0}/status'.format(pid)) as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        return None
+
+
+class Server(object):
+    """server.py running in its own process and working directory."""
+
+    def __init__(self, port, dbtype):
+        self.port = port
+        self.dir = tempfile.mkdtemp(prefix='qanda-loadgen-')
+        env = dict(os.environ, PORT=str(port), QANDA_DB_TYPE=dbtype)
+        self.proc = subprocess.Popen(
+            [sys.executable, os.path.join(_root, 'server.py')],
+            cwd=self.dir, env=env)
+        self._wait_until_listening()
+
+    def _wait_until_listening(self, timeout=30):
+        end = time.time() + timeout
+        while time.time() < end:
+            try:
+                socket.create_connection(('127.0.0.1', self.port), 1).close()
+                return
+            except socket.error:
+                if self.proc.poll() is not None:
+                    raise RuntimeError('server.py exited')
+                time.sleep(0.1)
+        raise RuntimeError('server.py did not start')
+
+    def create_topic(self, name):
+        """Add a topic through the lobby and return its id."""
+        url = 'http://127.0.0.1:{0}/'.format(self.port)
+        client = HTTPClient()
+        body = client.fetch(url, method='POST',
+                            body=urllib.urlencode({'topic': name})).body
+        client.close()
+        match = re.search(r'href="/qa-(\d+)">{0}<'.format(re.escape(name)),
+                          body)
+        return int(match.group(1))
+
+    def rss(self):
+        return rss(self.proc.pid)
+
+    def stop(self):
+        self.proc.terminate()
+        self.proc.wait()
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+
+@gen.coroutine
+def join_all(clients, topicid, concurrency, resume=False):
+    """Join all the clients (or resume their sessions), at most
+    concurrency at a time; returns the (start, end) times."""
+
+    start = time.time()
+    for i in xrange(0, len(clients), concurrency):
+        yield [c.resume(topicid) if resume else c.join(topicid)
+               for c in clients[i:i + concurrency]]
+    raise gen.Return((start, time.time()))
+
+
+def sleep(seconds):
+    return gen.Task(ioloop.IOLoop.instance().add_timeout,
+                    time.time() + seconds)
+
+
+@gen.coroutine
+def wait_for_parent(conn):
+    """Return once the parent has sent something on conn, running the
+    ioloop (and so the heartbeats) in the meantime."""
+
+    while not conn.poll():
+        yield sleep(0.05)
+    conn.recv()
+
+
+@gen.coroutine
+def steady(worker, clients, posters, topicid, stats, args):
+    """Post from posters in turn, args.post_rate / args.procs messages
+    a second, for args.duration seconds; returns the (start, end) times."""
+
+    interval = float(args.procs) / args.post_rate
+    start = time.time()
+    while time.time() - start < args.duration:
+        if posters:
+            poster = posters[stats.sent % len(posters)]
+            poster.post(topicid, POST_FORMAT.format(
+                '{0}-{1}'.format(worker, stats.sent), time.time()))
+            stats.sent += 1
+        yield sleep(interval)
+    end = time.time()
+    # give the last posts time to arrive
+    yield sleep(2)
+    raise gen.Return((start, end))
+
+
+def worker_main(worker, conn, url, topicid, args):
+    """Run the share of the clients for worker, in step with the parent:
+    join, report, then run the rest of the scenario once told to."""
+
+    stats = Stats()
+    n = args.clients // args.procs + (worker < args.clients % args.procs)
+    clients = [Client(url, args.encoding, stats) for _ in xrange(n)]
+    nposters = (args.posters // args.procs +
+                (worker < args.posters % args.procs))
+    concurrency = max(1, args.concurrency // args.procs)
+    loop = ioloop.IOLoop.instance()
+    # keep the joined clients from being reaped as idle for as long as
+    # the scenario takes
+    heartbeats = ioloop.PeriodicCallback(
+        lambda: [c.heartbeat() for c in clients], HEARTBEAT_INTERVAL * 1000)
+    heartbeats.start()
+
+    conn.send(loop.run_sync(lambda: join_all(clients, topicid, concurrency)))
+    loop.run_sync(lambda: wait_for_parent(conn))
+    result = {}
+    if args.scenario == 'steady_qa':
+        result['steady'] = loop.run_sync(
+            lambda: steady(worker, clients, clients[:nposters], topicid,
+                           stats, args))
+    elif args.scenario == 'reconnect_storm':
+        for c in clients:
+            c.close()
+        # let the server see the closes before everyone comes back
+        loop.run_sync(lambda: sleep(1))
+        result['rejoin'] = loop.run_sync(
+            lambda: join_all(clients, topicid, concurrency, resume=True))
+    result['sent'] = stats.sent
+    result['resumed'] = stats.resumed
+    result['seen'] = list(stats.seen)
+    result['latencies'] = stats.latencies
+    heartbeats.stop()
+    for c in clients:
+        c.close()
+    conn.send(result)
+
+
+def span_rate(n, spans):
+    """Return n divided by the time from the first start to the last end."""
+    return n / (max(end for (start, end) in spans) -
+                min(start for (start, end) in spans))
+
+
+def receive(workers):
+    """Return what each worker sends next, in order; raises
+    RuntimeError if a worker dies first."""
+
+    results = []
+    for (i, (proc, conn)) in enumerate(workers):
+        try:
+            while not conn.poll(WORKER_POLL):
+                if not proc.is_alive():
+                    raise EOFError
+            results.append(conn.recv())
+        except EOFError:
+            proc.join()
+            raise RuntimeError('worker {0} exited with code {1}'
+                               .format(i, proc.exitcode))
+    return results
+
+
+def run_scenario(server, args):
+    url = 'ws://127.0.0.1:{0}/ws/1?enc={1}'.format(server.port, args.encoding)
+    topicid = server.create_topic('loadgen {0}'.format(time.time()))
+    results = {}
+
+    rss_before = server.rss()
+    workers = []
+    for i in xrange(args.procs):
+        (parent, child) = multiprocessing.Pipe()
+        proc = multiprocessing.Process(target=worker_main,
+                                       args=(i, child, url, topicid, args))
+        proc.start()
+        child.close()
+        workers.append((proc, parent))
+
+    try:
+        joins = receive(workers)
+        results['joins_per_sec'] = span_rate(args.clients, joins)
+        rss_after = server.rss()
+        if rss_before is not None and rss_after is not None:
+            results['memory_per_connection'] = \
+                (rss_after - rss_before) / float(args.clients)
+
+        for (proc, conn) in workers:
+            conn.send('go')
+        done = receive(workers)
+    finally:
+        for (proc, conn) in workers:
+            proc.join(WORKER_POLL)
+            if proc.is_alive():
+                proc.terminate()
+
+    if args.scenario == 'steady_qa':
+        seen = set()
+        for d in done:
+            seen.update(d['seen'])
+        results['posts_sent'] = sum(d['sent'] for d in done)
+        results['posts_completed'] = len(seen)
+        results['posts_per_sec'] = span_rate(len(seen),
+                                             [d['steady'] for d in done])
+    elif args.scenario == 'reconnect_storm':
+        results['reconnects_per_sec'] = span_rate(args.clients,
+                                                  [d['rejoin'] for d in done])
+        results['sessions_resumed'] = sum(d['resumed'] for d in done)
+    latencies = sum((d['latencies'] for d in done), [])
+    if latencies:
+        results['broadcast_latency_p50'] = percentile(latencies, 50)
+        results['broadcast_latency_p99'] = percentile(latencies, 99)
+    return results
+
+
+def run(args):
+    # each client needs a socket in this process and in the server
+    (soft, hard) = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    server = Server(args.port, args.db)
+    try:
+        results = run_scenario(server, args)
+    finally:
+        server.stop()
+
+    report = {'scenario': args.scenario,
+              'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+              'params': {'clients': args.clients,
+                         'concurrency': args.concurrency,
+                         'procs': args.procs,
+                         'db': args.db,
+                         'encoding': args.encoding,
+                         'posters': args.posters,
+                         'post_rate': args.post_rate,
+                         'duration': args.duration},
+              'results': results}
+    for (name, value) in sorted(results.items()):
+        print '{0:28} {1}'.format(name, value)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+
+def compare(args):
+    with open(args.old) as f:
+        old = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    if old['params'] != new['params'] or old['scenario'] != new['scenario']:
+        print 'warning: the runs used different scenarios or parameters'
+    print '{0:28} {1:>14} {2:>14} {3:>9}'.format('', 'old', 'new', 'change')
+    for name in sorted(set(old['results']) | set(new['results'])):
+        a = old['results'].get(name)
+        b = new['results'].get(name)
+        change = ''
+        if a and b is not None:
+            change = '{0:+.1f}%'.format(100.0 * (b - a) / a)
+        print '{0:28} {1:>14} {2:>14} {3:>9}'.format(
+            name, '{0:.6g}'.format(a) if a is not None else '-',
+            '{0:.6g}'.format(b) if b is not None else '-', change)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    commands = parser.add_subparsers()
+
+    runp = commands.add_parser('run', help='run a scenario')
+    runp.set_defaults(func=run)
+    runp.add_argument('scenario', choices=SCENARIOS)
+    runp.add_argument('--clients', type=int, default=1000)
+    runp.add_argument('--procs', type=int,
+                      default=multiprocessing.cpu_count(),
+                      help='number of processes running the clients')
+    runp.add_argument('--concurrency', type=int, default=200,
+                      help='number of clients connecting at once')
+    runp.add_argument('--db', choices=['dummy', 'file'], default='dummy')
+    runp.add_argument('--encoding', choices=message.ENCODINGS,
+                      default=message.ENC_JSON)
+    runp.add_argument('--posters', type=int, default=10,
+                      help='number of clients posting (steady_qa)')
+    runp.add_argument('--post-rate', type=float, default=5,
+                      help='posts per second in total (steady_qa); keep '
+                      'this within the rate limits in settings.py')
+    runp.add_argument('--duration', type=float, default=30,
+                      help='seconds to post for (steady_qa)')
+    runp.add_argument('--port', type=int, default=9600)
+    runp.add_argument('--out', help='save the results to this JSON file')
+
+    comparep = commands.add_parser('compare', help='compare two saved runs')
+    comparep.set_defaults(func=compare)
+    comparep.add_argument('old')
+    comparep.add_argument('new')
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
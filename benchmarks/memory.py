@@ -0,0 +1,123 @@
+"""Measure the memory used per message by a loaded message tree.
+
+Compares the current models with the dict based models they replaced.
+Usage: python benchmarks/memory.py [nmessages]
+"""
+
+import os
+import sys
+import random
+import datetime
+import resource
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import models
+
+# number of distinct users posting, and the chance a message is a reply
+NUSERS = 200
+REPLY_FRACTION = 0.8
+
+
+class LegacyMessage(object):
+    """A message as it was before the models used __slots__."""
+
+    def __init__(self, user, message, parentid, posttime, topicid, id):
+        self.user = user
+        self.message = message
+        self.id = id
+        self.topicid = topicid
+        self.parentid = parentid
+        self.posttime = posttime
+
+
+class LegacyMessageTree(object):
+    """A message tree as it was before it used arrays."""
+
+    def __init__(self):
+        self._rootnodes = []
+        self._children = {}
+        self._messages = {}
+        self._order = []
+        self._position = {}
+        self._rootindex = {}
+
+    def add_message(self, mnode):
+        if mnode.parentid == -1:
+            self._rootindex[mnode.id] = len(self._rootnodes)
+            self._rootnodes.append(mnode.id)
+        else:
+            self._children[mnode.parentid].append(mnode.id)
+        self._children[mnode.id] = []
+        self._messages[mnode.id] = mnode
+        self._position[mnode.id] = len(self._order)
+        self._order.append(mnode.id)
+
+
+def build_legacy(n):
+    tree = LegacyMessageTree()
+    for (mid, parentid, user, text) in generate(n):
+        # every message got its own copy of the handle, as it does
+        # when decoded from json
+        tree.add_message(LegacyMessage(user[:1] + user[1:], text, parentid,
+                                       datetime.datetime.now(), 0, mid))
+    return tree
+
+
+def build_compact(n):
+    tree = models.MessageTree()
+    for (mid, parentid, user, text) in generate(n):
+        tree.add_message(models.Message(user[:1] + user[1:], text, parentid,
+                                        topicid=0, id=mid))
+    return tree
+
+
+def generate(n):
+    """Yield (id, parentid, user, message) for n messages."""
+    rand = random.Random(0)
+    for mid in xrange(n):
+        if mid and rand.random() < REPLY_FRACTION:
+            parentid = rand.randrange(mid)
+        else:
+            parentid = -1
+        user = 'user{0}'.format(rand.randrange(NUSERS))
+        yield (mid, parentid, user, 'message {0}'.format(mid))
+
+
+def max_rss():
+    """Return the peak memory used by this process in bytes."""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on os x
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def measure(build, n):
+    """Return the bytes per message used by build(n), measured in a
+    child process so that each run starts from a clean heap."""
+    rfd, wfd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(rfd)
+        before = max_rss()
+        tree = build(n)
+        os.write(wfd, str((max_rss() - before) / float(n)))
+        os._exit(0)
+    os.close(wfd)
+    result = float(os.read(rfd, 64))
+    os.close(rfd)
+    os.waitpid(pid, 0)
+    return result
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 500000
+    legacy = measure(build_legacy, n)
+    compact = measure(build_compact, n)
+    print '{0} messages'.format(n)
+    print 'legacy:  {0:8.1f} bytes/message'.format(legacy)
+    print 'compact: {0:8.1f} bytes/message'.format(compact)
+    print 'saving:  {0:8.1f}%'.format(100 * (1 - compact / legacy))
+
+
+if __name__ == '__main__':
+    main()
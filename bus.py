@@ -0,0 +1,270 @@
+"""Publish/subscribe message bus shared by the worker processes.
+
+When the server runs as several processes, each BackEnd publishes the
+events that the other processes need to know about (new topics, new
+messages and users joining and leaving topics), and subscribes to the
+events published by the others.
+
+Two buses are available:
+
+LocalBus - for a single process; published data is passed straight to
+           the subscribers.
+RedisBus - talks the publish/subscribe part of the Redis protocol, to
+           either a Redis server or the BusBroker in this module.
+
+Run this module to start a stand-alone BusBroker:
+
+    $ python bus.py [port]
+"""
+
+import logging
+import socket
+import sys
+from collections import deque
+
+import tornado.ioloop
+import tornado.iostream
+import tornado.tcpserver
+from tornado import gen
+
+import metrics
+
+log = logging.getLogger(__name__)
+
+class BusError(Exception):
+    pass
+
+
+class LocalBus(object):
+    """Bus for a single process."""
+
+    def __init__(self):
+        # channel -> list of callbacks
+        self._callbacks = {}
+
+    def subscribe(self, channel, callback):
+        """Call callback(data) for everything published on channel."""
+        self._callbacks.setdefault(channel, []).append(callback)
+
+    def publish(self, channel, data):
+        for callback in self._callbacks.get(channel, []):
+            callback(data)
+
+    def close(self):
+        pass
+
+
+def encode_command(*args):
+    """Return args (strings) encoded as a Redis protocol command."""
+    parts = ['*{0}\r\n'.format(len(args))]
+    for a in args:
+        parts.append('${0}\r\n{1}\r\n'.format(len(a), a))
+    return ''.join(parts)
+
+
+@gen.coroutine
+def read_value(stream):
+    """Read a single Redis protocol value from the IOStream stream."""
+
+    line = yield gen.Task(stream.read_until, '\r\n')
+    kind, rest = line[0], line[1:-2]
+    if kind == '*':
+        values = []
+        for i in range(int(rest)):
+            value = yield read_value(stream)
+            values.append(value)
+        raise gen.Return(values)
+    elif kind == '$':
+        if int(rest) < 0:
+            raise gen.Return(None)
+        data = yield gen.Task(stream.read_bytes, int(rest) + 2)
+        raise gen.Return(data[:-2])
+    elif kind == ':':
+        raise gen.Return(int(rest))
+    elif kind == '-':
+        raise BusError(rest)
+    raise gen.Return(rest)
+
+
+class RedisBus(object):
+    """Bus using the PUBLISH and SUBSCRIBE commands of the Redis protocol.
+
+    Redis needs separate connections for publishing and subscribing.
+    Both are reopened automatically if they drop; anything published
+    while the publishing connection is down is sent once it is back (up
+    to MAX_PENDING commands).  Nothing is published until the subscribing
+    connection is set up, so that replies to early messages (the 'hello'
+    a BackEnd publishes on starting) are not missed.
+    """
+
+    RECONNECT_DELAY = 1.0
+    MAX_PENDING = 10000
+
+    def __init__(self, host, port, password=None):
+        self.address = (host, port)
+        self.password = password
+        self._callbacks = {}
+        self._pending = deque(maxlen=self.MAX_PENDING)
+        self._pub = None
+        self._sub = None
+        # until the subscriptions are in place, publishing is held back,
+        # so that the replies to anything we publish are not missed
+        self._subscribed = False
+        self._closed = False
+        self._connect_pub()
+        self._connect_sub()
+
+    def subscribe(self, channel, callback):
+        if channel not in self._callbacks:
+            self._callbacks[channel] = []
+            if self._sub is not None:
+                self._sub.write(encode_command('SUBSCRIBE', channel))
+        self._callbacks[channel].append(callback)
+
+    def publish(self, channel, data):
+        command = encode_command('PUBLISH', channel, data)
+        if self._pending or not self._can_publish():
+            if len(self._pending) == self.MAX_PENDING:
+                metrics.incr('bus_dropped')
+            self._pending.append(command)
+        else:
+            self._pub.write(command)
+        metrics.incr('bus_published')
+
+    def _can_publish(self):
+        return self._pub is not None and (self._subscribed or
+                                          not self._callbacks)
+
+    def _send_pending(self):
+        if self._can_publish():
+            while self._pending:
+                self._pub.write(self._pending.popleft())
+
+    def close(self):
+        self._closed = True
+        for stream in (self._pub, self._sub):
+            if stream is not None:
+                stream.close()
+
+    def _connect(self, on_connected, on_closed):
+        stream = tornado.iostream.IOStream(socket.socket())
+        stream.set_close_callback(on_closed)
+
+        def connected():
+            if self.password is not None:
+                stream.write(encode_command('AUTH', self.password))
+            on_connected(stream)
+
+        stream.connect(self.address, connected)
+
+    def _reconnect(self, connect):
+        if not self._closed:
+            ioloop = tornado.ioloop.IOLoop.instance()
+            ioloop.add_timeout(ioloop.time() + self.RECONNECT_DELAY, connect)
+
+    def _connect_pub(self):
+        self._connect(self._on_pub_connected, self._on_pub_closed)
+
+    def _on_pub_connected(self, stream):
+        self._pub = stream
+        self._send_pending()
+        self._discard_replies(stream)
+
+    def _on_pub_closed(self):
+        self._pub = None
+        self._reconnect(self._connect_pub)
+
+    @gen.coroutine
+    def _discard_replies(self, stream):
+        # the replies to PUBLISH are just subscriber counts
+        while not stream.closed():
+            try:
+                yield read_value(stream)
+            except BusError as e:
+                log.error('bus error: %s', e)
+
+    def _connect_sub(self):
+        self._connect(self._on_sub_connected, self._on_sub_closed)
+
+    def _on_sub_connected(self, stream):
+        self._sub = stream
+        for channel in self._callbacks:
+            stream.write(encode_command('SUBSCRIBE', channel))
+        self._read_messages(stream)
+
+    def _on_sub_closed(self):
+        self._sub = None
+        self._reconnect(self._connect_sub)
+
+    @gen.coroutine
+    def _read_messages(self, stream):
+        while not stream.closed():
+            try:
+                value = yield read_value(stream)
+            except BusError as e:
+                log.error('bus error: %s', e)
+                continue
+            if not isinstance(value, list):
+                # the reply to AUTH
+                continue
+            if (value[0] == 'subscribe' and len(value) == 3 and
+                    not self._subscribed and
+                    value[2] >= len(self._callbacks)):
+                self._subscribed = True
+                self._send_pending()
+            elif value[0] == 'message':
+                for callback in self._callbacks.get(value[1], []):
+                    # a bad message must not stop us reading the rest
+                    try:
+                        callback(value[2])
+                    except Exception:
+                        log.exception('error handling bus message on %s',
+                                      value[1])
+
+
+class BusBroker(tornado.tcpserver.TCPServer):
+    """A stand-in for Redis that understands PUBLISH, SUBSCRIBE and PING."""
+
+    def __init__(self):
+        super(BusBroker, self).__init__()
+        # channel -> set of subscribed streams
+        self._subscribers = {}
+
+    @gen.coroutine
+    def handle_stream(self, stream, address):
+        stream.set_close_callback(lambda: self._unsubscribe(stream))
+        while not stream.closed():
+            command = yield read_value(stream)
+            if not isinstance(command, list) or not command:
+                continue
+            name = command[0].upper()
+            if name == 'PUBLISH' and len(command) == 3:
+                self._publish(stream, command[1], command[2])
+            elif name == 'SUBSCRIBE':
+                for (i, channel) in enumerate(command[1:]):
+                    self._subscribers.setdefault(channel, set()).add(stream)
+                    stream.write('*3\r\n$9\r\nsubscribe\r\n${0}\r\n{1}\r\n'
+                                 ':{2}\r\n'.format(len(channel), channel,
+                                                     i + 1))
+            elif name == 'PING':
+                stream.write('+PONG\r\n')
+            else:
+                stream.write('-ERR unknown command {0}\r\n'.format(name))
+
+    def _publish(self, stream, channel, data):
+        subscribers = self._subscribers.get(channel, ())
+        message = encode_command('message', channel, data)
+        for sub in subscribers:
+            sub.write(message)
+        stream.write(':{0}\r\n'.format(len(subscribers)))
+
+    def _unsubscribe(self, stream):
+        for subscribers in self._subscribers.values():
+            subscribers.discard(stream)
+
+
+if __name__ == "__main__":
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 9501
+    broker = BusBroker()
+    broker.listen(port, '127.0.0.1')
+    tornado.ioloop.IOLoop.instance().start()
@@ -3,14 +3,36 @@
 We store messages in the JSON format defined in message.to_json
 """
 
+import datetime
+import fcntl
 import json
+import logging
 import os
+import Queue
+import threading
+import time
 import psycopg2
+import psycopg2.errorcodes
+import psycopg2.extensions
+import psycopg2.pool
+import psycopg2.tz
 import urlparse
+from contextlib import contextmanager
 
 from settings import *
+import metrics
+from ids import IdAllocator, BlockAllocator, FileBlockAllocator
 # Topic and Message are the only models that are persistent currently
 from models import Topic, Message, to_json
+from search import SearchIndex, message_text, tokenize
+
+log = logging.getLogger(__name__)
+
+
+def _timed(fn):
+    """Observe the time taken by each call of the db method fn."""
+    return metrics.timed('db', call=fn.__name__)(fn)
+
 
 class MessageDb(object):
     """Base class."""
@@ -35,6 +57,198 @@ class MessageDb(object):
         """Return a list of all messages for the particular topicid."""
         return []
 
+    def get_messages_for_topics(self, topicids):
+        """Return a dict with the list of all messages for each topicid."""
+        return dict((tid, self.get_all_messages_for_topic(tid))
+                    for tid in topicids)
+
+    def get_message_counts(self):
+        """Return a dict with the number of messages in each topic (topics
+        without messages may be left out)."""
+        counts = {}
+        for m in self.get_all_messages():
+            counts[m.topicid] = counts.get(m.topicid, 0) + 1
+        return counts
+
+    def get_last_post_times(self):
+        """Return a dict with the post time of the newest message in each
+        topic, as seconds since the epoch (topics without messages may be
+        left out)."""
+        times = {}
+        for m in self.get_all_messages():
+            times[m.topicid] = max(times.get(m.topicid, 0), m.timestamp)
+        return times
+
+    def get_max_message_id(self):
+        """Return the largest message id in the db, or -1 if empty."""
+        return max([m.id for m in self.get_all_messages()] or [-1])
+
+    def search_messages(self, query, topicids=None, limit=20):
+        """Return (topicid, id) for the best limit messages that contain
+        all the words in query, best first, from the topics topicids (or
+        from all topics if None)."""
+        index = SearchIndex()
+        topic_of = {}
+        for m in self.get_all_messages():
+            if topicids is None or m.topicid in topicids:
+                index.add(m.id, message_text(m))
+                topic_of[m.id] = m.topicid
+        return [(topic_of[mid], mid)
+                for (score, mid) in index.search(query, limit)]
+
+    def id_allocator(self, name, worker=0, nworkers=1):
+        """Return the allocator for new 'users', 'topics' or 'messages'
+        ids, for worker process number worker out of nworkers."""
+
+        ids = IdAllocator(worker, nworkers)
+        ids.skip_past(self._get_max_id(name))
+        return ids
+
+    def _get_max_id(self, name):
+        """Return the largest id in use for name, or -1 if none."""
+        if name == 'messages':
+            return self.get_max_message_id()
+        elif name == 'topics':
+            return max([t.id for t in self.get_all_topics()] or [-1])
+        return -1
+
+    def close(self):
+        """Write anything still pending to the db."""
+        pass
+
+
+class WriteBehindError(Exception):
+    """The rows waiting to be written could not be written in time."""
+    pass
+
+
+class WriteBehindQueue(object):
+    """Pass items to writefn in batches from a background thread.
+
+    A batch is written once it holds batch_size items, or flush_interval
+    seconds after its first item was queued, whichever comes first.
+    writefn returns the items it could not write (or raises if it could
+    write none of them), and these are tried again by themselves after
+    retry_delay seconds, and then at doubling intervals of up to
+    max_retry_delay seconds until they are written.  At most
+    max_pending items can be waiting; put() blocks beyond that until
+    the writer has caught up.  flush() waits at most flush_timeout
+    seconds, so that a read does not hang while the db is down.
+    """
+
+    # queued by flush() and close() to end the current batch early
+    _FLUSH = object()
+    _STOP = object()
+
+    def __init__(self, writefn, batch_size, flush_interval, max_pending,
+                 retry_delay, max_retry_delay, flush_timeout):
+        self.writefn = writefn
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.flush_timeout = flush_timeout
+        self._queue = Queue.Queue(max_pending)
+        # once set, items that can not be written are given up on
+        self._closing = threading.Event()
+        self._thread = threading.Thread(target=self._run,
+                                        name='write-behind')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def put(self, item):
+        if self._queue.full():
+            metrics.incr('write_behind_full')
+            log.warning('write-behind queue is full, waiting for the db')
+        self._queue.put(item)
+
+    def flush(self):
+        """Block until everything queued so far has been written; raises
+        WriteBehindError if that takes longer than flush_timeout."""
+
+        end = time.time() + self.flush_timeout
+        try:
+            self._queue.put(self._FLUSH, True, self.flush_timeout)
+            # Queue.join() with a timeout
+            with self._queue.all_tasks_done:
+                while self._queue.unfinished_tasks:
+                    remaining = end - time.time()
+                    if remaining <= 0:
+                        raise Queue.Full
+                    self._queue.all_tasks_done.wait(remaining)
+        except Queue.Full:
+            metrics.incr('write_behind_flush_timeouts')
+            raise WriteBehindError('rows not written after {0} s'
+                                   .format(self.flush_timeout))
+
+    def close(self):
+        """Write everything still queued and stop the writer thread;
+        anything that can not be written now is lost."""
+        if self._thread.is_alive():
+            self._closing.set()
+            self._queue.put(self._STOP)
+            self._thread.join()
+
+    def _run(self):
+        stop = False
+        while not stop:
+            (items, ntaken, stop) = self._next_batch()
+            delay = self.retry_delay
+            # while the failed items are retried nothing else is taken
+            # from the queue, so that once it is full put() blocks
+            while items:
+                items = self._write(items)
+                if not items:
+                    break
+                if self._closing.is_set():
+                    log.error('giving up on writing %d rows', len(items))
+                    metrics.incr('write_behind_dropped', len(items))
+                    break
+                log.error('could not write %d rows, retrying in %g s',
+                          len(items), delay)
+                self._closing.wait(delay)
+                delay = min(2 * delay, self.max_retry_delay)
+            for i in range(ntaken):
+                self._queue.task_done()
+
+    def _write(self, items):
+        """Return the items that writefn could not write."""
+
+        start = time.time()
+        try:
+            failed = self.writefn(items)
+        except Exception:
+            # keep the writer alive whatever happens
+            log.exception('error writing %d rows', len(items))
+            failed = items
+        metrics.observe('write_behind_batch', time.time() - start)
+        if failed:
+            metrics.incr('write_behind_failed', len(failed))
+        return failed
+
+    def _next_batch(self):
+        """Return (items, number of queue entries taken, stop)."""
+
+        entry = self._queue.get()
+        ntaken = 1
+        items = []
+        deadline = time.time() + self.flush_interval
+        while True:
+            if entry is self._STOP:
+                return (items, ntaken, True)
+            if entry is self._FLUSH:
+                break
+            items.append(entry)
+            timeout = deadline - time.time()
+            if len(items) >= self.batch_size or timeout <= 0:
+                break
+            try:
+                entry = self._queue.get(True, timeout)
+            except Queue.Empty:
+                break
+            ntaken += 1
+        return (items, ntaken, False)
+
 
 class DummyDb(MessageDb):
     # if True, use dummy data, otherwise no data
@@ -52,7 +266,7 @@ class DummyDb(MessageDb):
                                        posttime='14 April 2014 19:21')],
                   'topics': [Topic('How to maximise awesomeness', id=1)]}
 
-    def __init__(self):
+    def __init__(self, drop=DB_DROP):
         super(DummyDb, self).__init__()
 
     def get_all_messages(self):
@@ -77,146 +291,677 @@ class DummyDb(MessageDb):
 
 
 class FileDb(MessageDb):
+    """Messages and topics are stored one JSON object per line.
+
+    The index file has a line 'topicid id offset length' for every
+    message, giving where in the message file the message is stored, so
+    that the messages of one topic can be read without reading the rest.
+    Writers append to the message and index files while holding a lock
+    on the index file, so several processes can share the files.
+
+    The terms file has a line 'offset length topicid id words...' for
+    every message, with the words of the message (see search.py), so
+    that the messages can be searched without parsing all of them.  It
+    is only read when the messages are first searched.
+    """
+
     # despite the .db extension, these are simply flat files
     mfilename   = 'message.db'
     tfilename   = 'topic.db'
+    ifilename   = 'message.idx'
+    sfilename   = 'message.terms'
+    # high-water marks of the ids handed out for users, topics and messages
+    idsfilename = '{0}.ids'
     
-    def __init__(self):
+    def __init__(self, drop=DB_DROP):
         super(FileDb, self).__init__()
 
         # create the files if they don't already exist (or want to drop them)
-        for fn in [self.mfilename, self.tfilename]:
-            if DB_DROP or not os.path.exists(fn):
+        for fn in [self.mfilename, self.tfilename, self.ifilename,
+                   self.sfilename]:
+            if drop or not os.path.exists(fn):
                 f = open(fn, 'w')
                 f.close()
-
+        if drop:
+            for name in ['users', 'topics', 'messages']:
+                if os.path.exists(self.idsfilename.format(name)):
+                    os.remove(self.idsfilename.format(name))
+
+        # the files are kept open, rather than opened for every write
+        self._mfile = open(self.mfilename, 'ab')
+        self._tfile = open(self.tfilename, 'ab')
+        self._ifile = open(self.ifilename, 'ab')
+        self._sfile = open(self.sfilename, 'ab')
+        self._mreader = open(self.mfilename, 'rb')
+        self._ireader = open(self.ifilename, 'rb')
+        self._sreader = open(self.sfilename, 'rb')
+
+        # topicid -> list of (offset, length) of its messages
+        self._offsets = {}
+        self._max_id = -1
+        # how much of the index file we have read into _offsets
+        self._ipos = 0
+        # the words of the messages (None until the first search), the
+        # topic of each message in it, how much of the terms file we
+        # have read, and the end of the messages in the message file
+        # that it covers
+        self._terms = None
+        self._topic_of = {}
+        self._spos = 0
+        self._send = 0
+        with self._locked():
+            self._read_index()
+            self._index_unindexed()
+
+    def id_allocator(self, name, worker=0, nworkers=1):
+        return FileBlockAllocator(self.idsfilename.format(name),
+                                  self._get_max_id(name) + 1, ID_BLOCK_SIZE)
+
+    @_timed
     def add_message(self, msg):
-        smsg = json.dumps(msg, default=to_json)
-        f = open(self.mfilename, 'a')
-        f.write(smsg + '\n')
-        f.close()
-
+        line = json.dumps(msg, default=to_json) + '\n'
+        with self._locked():
+            self._mfile.seek(0, os.SEEK_END)
+            offset = self._mfile.tell()
+            self._append((self._mfile, line),
+                         (self._ifile, '{0} {1} {2} {3}\n'.format(
+                             msg.topicid, msg.id, offset, len(line))),
+                         (self._sfile, self._terms_line(msg, offset,
+                                                        len(line))))
+
+    @_timed
     def get_all_messages(self):
-        f = open(self.mfilename, 'r')
-        lines = f.readlines()
-        f.close()
-        mdicts = [eval(lin) for lin in lines]
-        messages = [Message(m["user"], m["message"], m["parentid"],
-                            m["posttime"], m["topicid"], m["id"]) 
-                    for m in mdicts]
-        return messages
+        with open(self.mfilename, 'rb') as f:
+            return [self._message_from_json(line) for line in f
+                    if line.endswith('\n')]
 
+    @_timed
     def add_topic(self, topic):
-        stopic = json.dumps(topic, default=to_json)
-        f = open(self.tfilename, 'a')
-        f.write(stopic + '\n')
-        f.close()
+        self._append((self._tfile, json.dumps(topic, default=to_json) + '\n'))
 
+    @_timed
     def get_all_topics(self):
-        f = open(self.tfilename, 'r')
-        lines = f.readlines()
-        f.close()
-        tdicts = [eval(lin) for lin in lines]
-        topics = [Topic(t["name"], t["id"]) for t in tdicts]
-        return topics
+        with open(self.tfilename, 'rb') as f:
+            tdicts = [json.loads(line) for line in f if line.endswith('\n')]
+        return [Topic(t["name"], t["id"]) for t in tdicts]
 
+    @_timed
     def get_all_messages_for_topic(self, topicid):
+        # pick up anything other processes have written
+        self._read_index()
         msgs = []
-        for m in self.get_all_messages():
-            if (m.id == topicid):
-                msgs.append(m)
+        for (offset, length) in self._offsets.get(topicid, []):
+            self._mreader.seek(offset)
+            msgs.append(self._message_from_json(self._mreader.read(length)))
         return msgs
 
+    @_timed
+    def get_message_counts(self):
+        self._read_index()
+        return dict((tid, len(offsets))
+                    for (tid, offsets) in self._offsets.items())
+
+    @_timed
+    def get_last_post_times(self):
+        # messages are appended as they are posted, so the newest of a
+        # topic is its last
+        self._read_index()
+        times = {}
+        for (tid, offsets) in self._offsets.iteritems():
+            (offset, length) = offsets[-1]
+            self._mreader.seek(offset)
+            times[tid] = self._message_from_json(
+                self._mreader.read(length)).timestamp
+        return times
+
+    @_timed
+    def get_max_message_id(self):
+        self._read_index()
+        return self._max_id
+
+    @_timed
+    def search_messages(self, query, topicids=None, limit=20):
+        if self._terms is None:
+            self._terms = SearchIndex()
+            with self._locked():
+                self._search_unindexed()
+        else:
+            self._read_terms()
+        accept = None
+        if topicids is not None:
+            topicids = set(topicids)
+            accept = lambda mid: self._topic_of[mid] in topicids
+        return [(self._topic_of[mid], mid)
+                for (score, mid) in self._terms.search(query, limit, accept)]
+
+    def close(self):
+        for f in [self._mfile, self._tfile, self._ifile, self._sfile,
+                  self._mreader, self._ireader, self._sreader]:
+            f.close()
+
+    def _message_from_json(self, line):
+        m = json.loads(line)
+        return Message(m["user"], m["message"], m["parentid"],
+                       m["posttime"], m["topicid"], m["id"])
+
+    def _terms_line(self, msg, offset, length):
+        words = u' '.join(tokenize(message_text(msg))).encode('utf-8')
+        return '{0} {1} {2} {3} {4}\n'.format(offset, length, msg.topicid,
+                                              msg.id, words)
+
+    def _read_terms(self):
+        """Add any new (complete) lines of the terms file to _terms."""
+
+        self._sreader.seek(self._spos)
+        data = self._sreader.read()
+        data = data[:data.rfind('\n') + 1]
+        self._spos += len(data)
+        for line in data.splitlines():
+            fields = line.split(' ', 4)
+            (offset, length, topicid, msgid) = [int(x) for x in fields[:4]]
+            self._terms.add(msgid, fields[4].decode('utf-8'))
+            self._topic_of[msgid] = topicid
+            self._send = max(self._send, offset + length)
+
+    def _search_unindexed(self):
+        """Read the terms file, adding lines for any messages missing
+        from it (for example, those written before there was one)."""
+
+        self._read_terms()
+        end = self._send
+        if end > os.path.getsize(self.mfilename):
+            # the terms file doesn't belong to this message file
+            self._sfile.truncate(0)
+            self._terms = SearchIndex()
+            self._topic_of = {}
+            self._spos = self._send = end = 0
+
+        self._mreader.seek(end)
+        for line in iter(self._mreader.readline, ''):
+            if not line.endswith('\n'):
+                break
+            self._append((self._sfile, self._terms_line(
+                self._message_from_json(line), end, len(line))))
+            end += len(line)
+        self._read_terms()
+
+    def _append(self, *writes):
+        """Append data to f for each (f, data) in writes."""
+        for (f, data) in writes:
+            f.write(data)
+        for (f, data) in writes:
+            f.flush()
+            if FILEDB_FSYNC:
+                os.fsync(f.fileno())
+
+    @contextmanager
+    def _locked(self):
+        """Hold the lock on the index file."""
+        fcntl.flock(self._ifile.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._ifile.fileno(), fcntl.LOCK_UN)
+
+    def _read_index(self):
+        """Read any new (complete) lines from the index file."""
+
+        self._ireader.seek(self._ipos)
+        data = self._ireader.read()
+        data = data[:data.rfind('\n') + 1]
+        self._ipos += len(data)
+        for line in data.splitlines():
+            (topicid, msgid, offset, length) = [int(x) for x in line.split()]
+            self._offsets.setdefault(topicid, []).append((offset, length))
+            self._max_id = max(self._max_id, msgid)
+
+    def _index_unindexed(self):
+        """Add index lines for any messages missing from the index (for
+        example, a message file written before there was an index)."""
+
+        end = max([offset + length for offsets in self._offsets.values()
+                   for (offset, length) in offsets] or [0])
+        if end > os.path.getsize(self.mfilename):
+            # the index doesn't belong to this message file
+            self._ifile.truncate(0)
+            self._offsets = {}
+            self._max_id = -1
+            self._ipos = end = 0
+
+        self._mreader.seek(end)
+        for line in iter(self._mreader.readline, ''):
+            if not line.endswith('\n'):
+                break
+            m = json.loads(line)
+            self._append((self._ifile, '{0} {1} {2} {3}\n'.format(
+                m["topicid"], m["id"], end, len(line))))
+            end += len(line)
+        self._read_index()
+
+
+class PostgresBlockAllocator(BlockAllocator):
+    """Reserve blocks of ids from a PostgreSQL sequence that increments
+    by the block size."""
+
+    def __init__(self, db, sequence, block_size):
+        super(PostgresBlockAllocator, self).__init__(block_size)
+        self.db = db
+        self.sequence = sequence
+
+    def reserve(self, n):
+        return self.db.pool.run(self._nextval)
+
+    def _nextval(self, cursor):
+        cursor.execute('SELECT nextval(%s)', (self.sequence,))
+        return cursor.fetchone()[0]
+
+
+class PreparingConnection(psycopg2.extensions.connection):
+    """Connection that remembers the statements prepared on it."""
+
+    def __init__(self, *args, **kwargs):
+        super(PreparingConnection, self).__init__(*args, **kwargs)
+        self.prepared = set()
+
+
+class ConnectionPool(object):
+    """Thread safe pool of PostgreSQL connections.
+
+    A connection that has been idle for more than PG_POOL_CHECK_INTERVAL
+    seconds is checked before it is handed out, and replaced if it has
+    gone bad.  If the connection drops in the middle of run(), the work
+    is tried once more on a new connection.
+    """
+
+    def __init__(self, minconn, maxconn, **connect_args):
+        self._pool = psycopg2.pool.ThreadedConnectionPool(
+            minconn, maxconn, connection_factory=PreparingConnection,
+            **connect_args)
+        # id of each connection -> time it was last returned to the pool
+        self._last_used = {}
+
+    def run(self, fn, *args):
+        """Return fn(cursor, *args), run in a single transaction."""
+
+        with metrics.timer('db', {'call': fn.__name__}):
+            return self._run(fn, *args)
+
+    def _run(self, fn, *args):
+        for attempt in range(2):
+            conn = self._getconn()
+            try:
+                result = fn(conn.cursor(), *args)
+                conn.commit()
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                # the connection is broken
+                self._putconn(conn, close=True)
+                metrics.incr('db_reconnects')
+                if attempt:
+                    raise
+            except Exception:
+                self._reset(conn)
+                raise
+            else:
+                self._putconn(conn)
+                return result
+
+    def closeall(self):
+        self._pool.closeall()
+
+    def _reset(self, conn):
+        """Return conn to the pool after a failed transaction."""
+        try:
+            conn.rollback()
+            # forget any statements prepared during the transaction
+            conn.cursor().execute('DEALLOCATE ALL')
+            conn.commit()
+            conn.prepared.clear()
+        except psycopg2.Error:
+            self._putconn(conn, close=True)
+        else:
+            self._putconn(conn)
+
+    def _getconn(self):
+        conn = self._pool.getconn()
+        idle = time.time() - self._last_used.get(id(conn), time.time())
+        if conn.closed or idle > PG_POOL_CHECK_INTERVAL:
+            try:
+                conn.cursor().execute('SELECT 1')
+                conn.commit()
+            except psycopg2.Error:
+                self._putconn(conn, close=True)
+                metrics.incr('db_reconnects')
+                conn = self._pool.getconn()
+        return conn
+
+    def _putconn(self, conn, close=False):
+        if close:
+            self._last_used.pop(id(conn), None)
+        else:
+            self._last_used[id(conn)] = time.time()
+        self._pool.putconn(conn, close=close)
+
 
 class PostgresDb(MessageDb):
-    def __init__(self):
+    # order in which the tables of a batch are written (messages
+    # reference topics)
+    _TABLES = ['topics', 'messages']
+    # the sequences that ids are reserved from
+    _SEQUENCES = {'users': 'user_ids',
+                  'topics': 'topic_ids',
+                  'messages': 'message_ids'}
+    # statements that are prepared on each connection the first time
+    # they are used: name -> (argument types, statement)
+    _STATEMENTS = {'insert_message':
+                   ('(int, varchar, text, int, timestamptz, int)',
+                    'INSERT INTO messages VALUES($1, $2, $3, $4, $5, $6)'),
+                   'topic_messages':
+                   ('(int)', 'SELECT * FROM messages WHERE topicid=$1 '
+                    'ORDER BY seq')}
+    # the schema changes, in order.  The schema_version table holds the
+    # number that have been applied to the db.
+    _MIGRATIONS = ['_create_tables', '_migrate_posttime_and_indexes',
+                   '_create_search_index', '_add_insertion_order']
+    # DATE_FORMAT in PostgreSQL's to_timestamp format
+    _PG_DATE_FORMAT = 'DD FMMonth YYYY HH24:MI'
+    # the words of a message that are searched (this must match the
+    # expression of the messages_search index to use the index)
+    _SEARCH_VECTOR = "to_tsvector('simple', uname || ' ' || message)"
+
+    def __init__(self, drop=DB_DROP):
         self.settings = self._get_connection_information()
-        self.conn = psycopg2.connect(database=self.settings['database'],
-                                     user=self.settings['user'],
-                                     password=self.settings.get('password', None),
-                                     host=self.settings.get('host', None),
-                                     port=self.settings.get('port', None))
-        self.cursor = self.conn.cursor()
+        self.pool = ConnectionPool(self.settings['minconn'],
+                                   self.settings['maxconn'],
+                                   database=self.settings['database'],
+                                   user=self.settings['user'],
+                                   password=self.settings.get('password'),
+                                   host=self.settings.get('host'),
+                                   port=self.settings.get('port'))
         # drop all tables according to settings.py
-        if DB_DROP:
-            self._drop_all_tables()
-        self._create_tables_if_not_exist()
+        if drop:
+            self.pool.run(self._drop_all_tables)
+        self.pool.run(self._migrate)
+
+        # inserts are done by a background thread
+        self._writer = WriteBehindQueue(self._write_batch,
+                                        WRITE_BEHIND_BATCH_SIZE,
+                                        WRITE_BEHIND_INTERVAL,
+                                        WRITE_BEHIND_MAX_PENDING,
+                                        WRITE_BEHIND_RETRY_DELAY,
+                                        WRITE_BEHIND_MAX_RETRY_DELAY,
+                                        WRITE_BEHIND_FLUSH_TIMEOUT)
+        self._create_sequences()
 
     def _get_connection_information(self):
         """Set up settings dict."""
         dburl = os.environ.get("DATABASE_URL")
         if dburl is None:
             # local machine
-            return {'database': 'testdb',
+            info = {'database': 'testdb',
                     'user': 'jm0037'}
         else:
             # Heroku
             urlparse.uses_netloc.append("postgres")
             url = urlparse.urlparse(dburl)
-            return {'database': url.path[1:],
+            info = {'database': url.path[1:],
                     'user': url.username,
                     'password': url.password,
                     'host': url.hostname,
                     'port': url.port}
+        # the pool size can be set from the environment in either case
+        info['minconn'] = int(os.environ.get("PG_POOL_MIN", PG_POOL_MIN))
+        info['maxconn'] = int(os.environ.get("PG_POOL_MAX", PG_POOL_MAX))
+        return info
 
     def add_message(self, msg):
-        query = 'INSERT INTO messages VALUES(%s, %s, %s, %s, %s, %s)'
-        self.cursor.execute(query, (msg.id, msg.user, 
-                                    msg.message, msg.parentid,
-                                    msg.posttime.strftime(DATE_FORMAT),
-                                    msg.topicid))
-        self.conn.commit()
+        posttime = datetime.datetime.fromtimestamp(
+            msg.timestamp, psycopg2.tz.FixedOffsetTimezone(offset=0))
+        self._writer.put(('messages', (msg.id, msg.user,
+                                       msg.message, msg.parentid,
+                                       posttime, msg.topicid)))
 
     def add_topic(self, topic):
-        query = 'INSERT INTO topics VALUES(%s, %s)'
-        self.cursor.execute(query, (topic.id, topic.name))
-        self.conn.commit()
+        self._writer.put(('topics', (topic.id, topic.name)))
+
+    def close(self):
+        self._writer.close()
+        self.pool.closeall()
+
+    def _write_batch(self, items):
+        """Insert a batch of (table, row) items in a single transaction,
+        and return the items to try again later."""
+
+        rows = dict((table, []) for table in self._TABLES)
+        for (table, row) in items:
+            rows[table].append(row)
+        try:
+            self.pool.run(self._insert_tables, rows)
+            return []
+        except (psycopg2.IntegrityError, psycopg2.DataError) as e:
+            if not self._never_written(e):
+                raise
+        # a row can never be written (or was written before, by a batch
+        # whose commit we didn't hear back about), so write the rows one
+        # at a time to find it and save the others; any other error
+        # propagates, and the whole batch is retried
+        retry = []
+        for (table, row) in items:
+            try:
+                self.pool.run(self._insert_tables, {table: [row]})
+            except psycopg2.Error as e:
+                if self._never_written(e):
+                    log.error('could not write %s row %s: %s', table, row, e)
+                    metrics.incr('write_behind_dropped')
+                else:
+                    retry.append((table, row))
+        return retry
+
+    def _never_written(self, e):
+        """Return True if retrying the insert that raised the
+        psycopg2.Error e can not help.  A foreign key violation can: the
+        topic of a message may still be queued by another process."""
+        return (isinstance(e, psycopg2.DataError) or
+                (isinstance(e, psycopg2.IntegrityError) and
+                 e.pgcode == psycopg2.errorcodes.UNIQUE_VIOLATION))
+
+    def _insert_tables(self, cursor, rows):
+        for table in self._TABLES:
+            if rows.get(table):
+                self._insert_rows(cursor, table, rows[table])
+
+    def _insert_rows(self, cursor, table, rows):
+        if table == 'messages' and len(rows) == 1:
+            self._execute_prepared(cursor, 'insert_message', rows[0])
+            return
+        # a single multi-row INSERT for all the rows
+        placeholder = '(' + ', '.join(['%s'] * len(rows[0])) + ')'
+        values = ', '.join([cursor.mogrify(placeholder, row) for row in rows])
+        cursor.execute('INSERT INTO {0} VALUES {1}'.format(table, values))
+
+    def _execute_prepared(self, cursor, name, args):
+        prepared = cursor.connection.prepared
+        if name not in prepared:
+            (types, statement) = self._STATEMENTS[name]
+            cursor.execute('PREPARE {0} {1} AS {2}'
+                           .format(name, types, statement))
+            prepared.add(name)
+        cursor.execute('EXECUTE {0} ({1})'
+                       .format(name, ', '.join(['%s'] * len(args))), args)
 
     def get_all_topics(self):
-        self.cursor.execute('SELECT * FROM topics')
-        self.conn.commit()
-        topics = self.cursor.fetchall()
+        # make sure we read back anything still queued
+        self._writer.flush()
+        topics = self.pool.run(self._fetchall, 'SELECT * FROM topics')
         return [Topic(t[1], t[0]) for t in topics]
     
     def get_all_messages_for_topic(self, topicid):
-        self.cursor.execute('SELECT * FROM messages WHERE topicid=%s', (topicid,))
-        self.conn.commit()
-        messages = self.cursor.fetchall()
-        return [Message(user=m[1], message=m[2], parentid=m[3], 
-                        posttime=m[4]) for m in messages]
+        self._writer.flush()
+        messages = self.pool.run(self._fetch_topic_messages, topicid)
+        return [self._message_from_row(m) for m in messages]
+
+    def get_messages_for_topics(self, topicids):
+        # all the topics in one query
+        self._writer.flush()
+        messages = self.pool.run(self._fetchall,
+                                 'SELECT * FROM messages '
+                                 'WHERE topicid = ANY(%s) '
+                                 'ORDER BY topicid, seq',
+                                 (list(topicids),))
+        result = dict((tid, []) for tid in topicids)
+        for m in messages:
+            result[m[5]].append(self._message_from_row(m))
+        return result
+
+    def get_message_counts(self):
+        self._writer.flush()
+        return dict(self.pool.run(self._fetchall,
+                                  'SELECT topicid, count(*) FROM messages '
+                                  'GROUP BY topicid'))
+
+    def get_last_post_times(self):
+        self._writer.flush()
+        return dict(self.pool.run(self._fetchall,
+                                  'SELECT topicid, CAST(EXTRACT(EPOCH FROM '
+                                  'MAX(posttime)) AS BIGINT) FROM messages '
+                                  'GROUP BY topicid'))
+
+    def _message_from_row(self, m):
+        return Message(user=m[1], message=m[2], parentid=m[3], 
+                       posttime=m[4], topicid=m[5], id=m[0])
+
+    def _fetch_topic_messages(self, cursor, topicid):
+        self._execute_prepared(cursor, 'topic_messages', (topicid,))
+        return cursor.fetchall()
+
+    def get_max_message_id(self):
+        self._writer.flush()
+        return self.pool.run(
+            self._fetchall, 'SELECT COALESCE(MAX(id), -1) FROM messages')[0][0]
+
+    def search_messages(self, query, topicids=None, limit=20):
+        self._writer.flush()
+        args = [query]
+        where = ''
+        if topicids is not None:
+            where = 'AND topicid = ANY(%s) '
+            args.append(list(topicids))
+        args.append(limit)
+        return self.pool.run(self._fetchall,
+                             'SELECT topicid, id FROM messages, '
+                             "plainto_tsquery('simple', %s) query "
+                             'WHERE {0} @@ query {1}'
+                             'ORDER BY ts_rank({0}, query) DESC, id DESC '
+                             'LIMIT %s'.format(self._SEARCH_VECTOR, where),
+                             tuple(args))
+
+    def _execute(self, cursor, query, args=()):
+        cursor.execute(query, args)
+
+    def _fetchall(self, cursor, query, args=()):
+        cursor.execute(query, args)
+        return cursor.fetchall()
+
+    def id_allocator(self, name, worker=0, nworkers=1):
+        return PostgresBlockAllocator(self, self._SEQUENCES[name],
+                                      ID_BLOCK_SIZE)
+
+    def _create_sequences(self):
+        """Create the id sequences, starting after any ids already used."""
+
+        for (name, sequence) in self._SEQUENCES.items():
+            exists = self.pool.run(self._fetchall,
+                                   "SELECT 1 FROM pg_class "
+                                   "WHERE relname=%s AND relkind='S'",
+                                   (sequence,))
+            if not exists:
+                self.pool.run(self._execute,
+                              'CREATE SEQUENCE {0} MINVALUE 0 START WITH {1}'
+                              .format(sequence, self._get_max_id(name) + 1))
+            # the sequence hands out the first id of each block
+            self.pool.run(self._execute, 'ALTER SEQUENCE {0} INCREMENT BY {1}'
+                          .format(sequence, ID_BLOCK_SIZE))
     
-    def _drop_all_tables(self):
-        try:
-            self.cursor.execute('DROP table messages')
-            self.cursor.execute('DROP table topics')
-            self.conn.commit()
-        except psycopg2.ProgrammingError:
-            self.conn.commit()
-
-    def _create_tables_if_not_exist(self):
-        try:
-            self.cursor.execute('SELECT * FROM messages')
-            self.conn.commit()
-        except psycopg2.ProgrammingError:
-            # this will clear the previous transaction
-            self.conn.commit()
-            self._create_tables()
-
-    def _create_tables(self):
+    def _drop_all_tables(self, cursor):
+        cursor.execute('DROP TABLE IF EXISTS messages')
+        cursor.execute('DROP TABLE IF EXISTS topics')
+        cursor.execute('DROP TABLE IF EXISTS schema_version')
+        for sequence in self._SEQUENCES.values():
+            cursor.execute('DROP SEQUENCE IF EXISTS {0}'.format(sequence))
+
+    def _migrate(self, cursor):
+        """Apply any schema changes that the db doesn't have yet."""
+
+        cursor.execute('CREATE TABLE IF NOT EXISTS schema_version ('
+                       'version  INT          NOT NULL'
+                       ')')
+        # only one process at a time should change the schema
+        cursor.execute('LOCK TABLE schema_version')
+        cursor.execute('SELECT version FROM schema_version')
+        row = cursor.fetchone()
+        if row is None:
+            # tables created before there were migrations are version 1
+            cursor.execute("SELECT 1 FROM pg_class "
+                           "WHERE relname='messages' AND relkind='r'")
+            version = 0 if cursor.fetchone() is None else 1
+            cursor.execute('INSERT INTO schema_version VALUES(%s)',
+                           (version,))
+        else:
+            version = row[0]
+
+        for migration in self._MIGRATIONS[version:]:
+            log.info('migrating db: %s', migration)
+            getattr(self, migration)(cursor)
+        cursor.execute('UPDATE schema_version SET version=%s',
+                       (len(self._MIGRATIONS),))
+
+    def _migrate_posttime_and_indexes(self, cursor):
+        # posttime was stored as a string in DATE_FORMAT
+        cursor.execute('ALTER TABLE messages '
+                       'ALTER COLUMN posttime TYPE TIMESTAMPTZ '
+                       'USING to_timestamp(posttime, %s)',
+                       (self._PG_DATE_FORMAT,))
+        cursor.execute('CREATE INDEX messages_topicid_id '
+                       'ON messages (topicid, id)')
+        cursor.execute('CREATE INDEX messages_parentid '
+                       'ON messages (parentid)')
+
+    def _create_search_index(self, cursor):
+        cursor.execute('CREATE INDEX messages_search ON messages '
+                       'USING GIN ({0})'.format(self._SEARCH_VECTOR))
+
+    def _add_insertion_order(self, cursor):
+        # posttime is only to the second (the minute for old rows), and
+        # ids are handed out in blocks to each worker, so neither puts a
+        # parent before its replies; seq numbers the rows as they are
+        # inserted (existing rows as well as we can)
+        cursor.execute('ALTER TABLE messages ADD COLUMN seq BIGINT')
+        cursor.execute('UPDATE messages SET seq = o.n FROM '
+                       '(SELECT id, row_number() OVER '
+                       '(ORDER BY posttime, id) AS n FROM messages) o '
+                       'WHERE messages.id = o.id')
+        cursor.execute('CREATE SEQUENCE messages_seq OWNED BY messages.seq')
+        cursor.execute("SELECT setval('messages_seq', "
+                       'COALESCE(MAX(seq), 0) + 1, false) FROM messages')
+        cursor.execute("ALTER TABLE messages ALTER COLUMN seq "
+                       "SET DEFAULT nextval('messages_seq'), "
+                       "ALTER COLUMN seq SET NOT NULL")
+        cursor.execute('CREATE INDEX messages_topicid_seq '
+                       'ON messages (topicid, seq)')
+
+    def _create_tables(self, cursor):
         # note 'user' is a reserved work is psql so we use 'uname' instead
-        self.cursor.execute('CREATE TABLE topics ('
-                            'id       INT          NOT NULL PRIMARY KEY, '
-                            'name     VARCHAR(100) NOT NULL' 
-                            ')')
-        self.cursor.execute('CREATE TABLE messages ('
-                            'id       INT         NOT NULL PRIMARY KEY, '
-                            'uname    VARCHAR(50) NOT NULL, '
-                            'message  TEXT        NOT NULL, '
-                            'parentid INT         NOT NULL, '
-                            'posttime VARCHAR(50) NOT NULL, '
-                            'topicid  INT references topics(id) '
-                            ')')
-        self.conn.commit()
+        cursor.execute('CREATE TABLE topics ('
+                       'id       INT          NOT NULL PRIMARY KEY, '
+                       'name     VARCHAR(100) NOT NULL' 
+                       ')')
+        cursor.execute('CREATE TABLE messages ('
+                       'id       INT         NOT NULL PRIMARY KEY, '
+                       'uname    VARCHAR(50) NOT NULL, '
+                       'message  TEXT        NOT NULL, '
+                       'parentid INT         NOT NULL, '
+                       'posttime VARCHAR(50) NOT NULL, '
+                       'topicid  INT references topics(id) '
+                       ')')
 
 
 if (DB_TYPE == DB_FILE):
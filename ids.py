@@ -0,0 +1,83 @@
+"""Allocation of ids for users, topics and messages.
+
+Ids must be unique across server restarts and across worker processes.
+The databases do this by reserving blocks of ids from somewhere shared
+(a PostgreSQL sequence, or the high-water mark file of a FileBlockAllocator)
+and handing them out one at a time.  Without a persistent database, the
+ids of the workers are interleaved instead (worker k of n gets k, k + n,
+k + 2n ...).
+"""
+
+import fcntl
+import os
+
+
+class IdAllocator(object):
+    """Hand out the ids start, start + step, start + 2*step ..."""
+
+    def __init__(self, start=0, step=1):
+        self.step = step
+        self._next = start
+
+    def allocate(self):
+        """Return a new id."""
+        newid = self._next
+        self._next += self.step
+        return newid
+
+    def skip_past(self, usedid):
+        """Make sure all ids allocated from now on are larger than usedid."""
+        if usedid >= self._next:
+            self._next += ((usedid - self._next) // self.step + 1) * self.step
+
+
+class BlockAllocator(object):
+    """Hand out ids from blocks of block_size ids.
+
+    Subclasses define reserve(n), which returns the first id of a block
+    of n ids that no other allocator will use.
+    """
+
+    def __init__(self, block_size):
+        self.block_size = block_size
+        self._next = 0
+        self._end = 0
+
+    def allocate(self):
+        if self._next == self._end:
+            self._next = self.reserve(self.block_size)
+            self._end = self._next + self.block_size
+        newid = self._next
+        self._next += 1
+        return newid
+
+    def reserve(self, n):
+        raise NotImplementedError
+
+
+class FileBlockAllocator(BlockAllocator):
+    """Reserve blocks by moving up a high-water mark kept in a file.
+
+    The file is locked while it is updated, so it can be shared by
+    several processes.  Ids below first are never handed out.
+    """
+
+    def __init__(self, filename, first=0, block_size=100):
+        super(FileBlockAllocator, self).__init__(block_size)
+        self.filename = filename
+        self.first = first
+
+    def reserve(self, n):
+        fd = os.open(self.filename, os.O_RDWR | os.O_CREAT, 0644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            mark = os.read(fd, 64).strip()
+            start = max(int(mark) if mark else 0, self.first)
+            os.lseek(fd, 0, os.SEEK_SET)
+            os.ftruncate(fd, 0)
+            os.write(fd, str(start + n))
+            os.fsync(fd)
+        finally:
+            # closing the file also releases the lock
+            os.close(fd)
+        return start
@@ -0,0 +1,93 @@
+"""Track when we last heard from each connection, and reap idle ones.
+
+Every frame received from a client counts as a sign of life (clients
+send a heartbeat when they have nothing else to say), so recording one
+must be cheap: touch() just stores the time.  Finding the connections
+that have gone quiet is left to tick(), which is called every tick
+seconds and uses a timer wheel: each connection sits in the slot of the
+tick at which it may next expire, so a tick only looks at the
+connections in one slot.  A connection that was touched since it was
+put in the slot is moved on to the slot of its new deadline.
+"""
+
+import time
+
+import metrics
+
+
+class Liveness(object):
+    """Liveness of a set of connections, identified by userid."""
+
+    def __init__(self, timeout, tick, stale_after, reap):
+        """Connections not heard from in timeout seconds are passed to
+        reap(userid) and forgotten; those not heard from in stale_after
+        seconds are counted as stale until then."""
+
+        self.timeout = timeout
+        self.tick_interval = tick
+        self.stale_after = stale_after
+        self._reap = reap
+        # userid -> time we last heard from the connection
+        self._last_seen = {}
+        # the wheel: enough slots to hold a full timeout ahead of the
+        # current one
+        self._slots = [set() for _ in xrange(int(timeout // tick) + 2)]
+        # index of the slot due at the next tick, and the time of that tick
+        self._current = 0
+        self._next_tick = time.time() + tick
+
+    def add(self, userid, now=None):
+        self._last_seen[userid] = time.time() if now is None else now
+        self._schedule(userid, self._last_seen[userid] + self.timeout)
+
+    def touch(self, userid, now=None):
+        """Record that we heard from userid (if we are tracking it)."""
+        if userid in self._last_seen:
+            self._last_seen[userid] = time.time() if now is None else now
+
+    def remove(self, userid):
+        # the userid is left in its slot, and dropped when that slot is due
+        self._last_seen.pop(userid, None)
+
+    def __len__(self):
+        return len(self._last_seen)
+
+    def last_seen(self, userid):
+        return self._last_seen.get(userid)
+
+    def _schedule(self, userid, deadline):
+        ticks = int((deadline - self._next_tick) // self.tick_interval) + 1
+        ticks = min(max(ticks, 0), len(self._slots) - 1)
+        self._slots[(self._current + ticks) % len(self._slots)].add(userid)
+
+    def tick(self, now=None):
+        """Reap the connections that have been idle for timeout seconds,
+        and update the live and stale connection gauges.  Returns the
+        list of reaped userids."""
+
+        now = time.time() if now is None else now
+        reaped = []
+        while self._next_tick <= now:
+            due = self._slots[self._current]
+            self._slots[self._current] = set()
+            self._current = (self._current + 1) % len(self._slots)
+            self._next_tick += self.tick_interval
+            for userid in due:
+                seen = self._last_seen.get(userid)
+                if seen is None:
+                    continue
+                if seen + self.timeout <= now:
+                    del self._last_seen[userid]
+                    reaped.append(userid)
+                else:
+                    self._schedule(userid, seen + self.timeout)
+
+        for userid in reaped:
+            self._reap(userid)
+        metrics.incr('connections_reaped', len(reaped))
+
+        stale = sum(1 for seen in self._last_seen.itervalues()
+                    if seen + self.stale_after <= now)
+        metrics.gauge('connections_live', len(self._last_seen) - stale)
+        metrics.gauge('connections_stale', stale)
+        return reaped
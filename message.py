@@ -2,7 +2,8 @@
 
 Messages are passed between client and server as JSON formatted
 strings, which can be easily converted to and from Python dictionary
-objects.
+objects.  Messages from the server can instead use one of the more
+compact wire encodings below, if the client asks for it.
 
 To be valid these dicts must satisfy certain criteria (see
 validate_message below).
@@ -10,13 +11,15 @@ validate_message below).
 """
 
 import json
+import zlib
 import datetime
 from copy import deepcopy
 
 from settings import *
-from models import Message, Topic
+from models import Message, Topic, to_json
 
 ID_ALL = -1 # message id for a message to sent to all clients
+ROOT_PARENTID = -1 # parentid of a question (a root message)
 
 K_TYPE = 'mtype'
 K_ID = 'userid'
@@ -29,20 +32,86 @@ REQUIRED_MESSAGE_KEYS = [K_TYPE, K_ID, K_AUTH]
 M_TEST = 'test'
 # message types from server to client
 M_MYHANDLE = 'myhandle'
-M_NEWHANDLE = 'newhandle'
-M_REMOVEHANDLE = 'removehandle'
-M_FULLTREE = 'fulltree'
+M_ROSTER = 'roster'
+M_PRESENCE = 'presence'
+M_TREEPAGE = 'treepage'
+M_MISSED = 'missed'
 M_NEWMESSAGE = 'newmessage'
+M_RESUMED = 'resumed'
+M_SEARCHRESULTS = 'searchresults'
+M_THREADTREE = 'threadtree'
+M_THREADLIST = 'threadlist'
 # message types from client to server
+M_CONNECT = 'connect'  # the first on each connection; it has the userid,
+                       # auth_token and since of the session to resume,
+                       # if any (see BackEnd.add_user)
 M_SETTOPIC = 'settopic'
+M_MORETREE = 'moretree'
 M_RESPONSE = 'response'
 M_HEARTBEAT = 'heartbeat'
+M_SEARCH = 'search'
+M_GETTHREAD = 'getthread'
+M_TOPTHREADS = 'topthreads'
 # message types both ways
 M_CHANGEHANDLE = 'changehandle'
 
-ALLOWED_MESSAGES = [M_TEST, M_MYHANDLE, M_NEWHANDLE, M_REMOVEHANDLE,
-                    M_FULLTREE, M_NEWMESSAGE, M_SETTOPIC, M_RESPONSE, 
-                    M_HEARTBEAT, M_CHANGEHANDLE]
+# messages from the client that are sent on to every user in the topic
+FANOUT_MESSAGES = [M_RESPONSE, M_CHANGEHANDLE]
+
+# the client sends this (bare, not as JSON) as a heartbeat
+HEARTBEAT_FRAME = 'hb'
+
+ALLOWED_MESSAGES = [M_TEST, M_MYHANDLE, M_ROSTER, M_PRESENCE,
+                    M_TREEPAGE, M_MISSED, M_NEWMESSAGE, M_SETTOPIC,
+                    M_MORETREE, M_RESPONSE, M_HEARTBEAT, M_CHANGEHANDLE,
+                    M_RESUMED, M_SEARCH, M_SEARCHRESULTS, M_GETTHREAD,
+                    M_THREADTREE, M_TOPTHREADS, M_THREADLIST, M_CONNECT]
+
+# wire encodings of messages from server to client, chosen by the
+# client with the 'enc' argument of the websocket url
+ENC_JSON = 'json'        # JSON text frames
+ENC_COMPACT = 'compact'  # JSON text frames with the keys in SHORT_KEYS
+                         # shortened
+ENC_DEFLATE = 'deflate'  # as compact, but frames of DEFLATE_MIN_SIZE
+                         # bytes or more are zlib compressed binary frames
+ENCODINGS = [ENC_JSON, ENC_COMPACT, ENC_DEFLATE]
+
+# short versions of the keys in messages from the server (this must
+# match the table in static/websocket.js)
+SHORT_KEYS = {K_TYPE: 't', K_ID: 'u', K_AUTH: 'a', K_TSTAMP: 'ts',
+              'handle': 'h', 'changeid': 'c', 'newhandle': 'nh',
+              'tree': 'tr', 'before': 'b', 'message': 'm', 'messages': 'ms',
+              'rootnodes': 'rn', 'children': 'ch', 'more': 'mo', 'last': 'l',
+              'user': 'us', 'id': 'i', 'parentid': 'p', 'posttime': 'pt',
+              'topicid': 'o', 'roster': 'ro', 'joined': 'jo',
+              'left': 'le', 'query': 'qu', 'results': 'rs', 'thread': 'th',
+              'truncated': 'tc', 'threads': 'ths', 'replies': 'r',
+              'lastactivity': 'la'}
+
+
+def encode(messagedict, encoding):
+    """Return messagedict in the wire encoding as (data, binary),
+    where binary is True if data should be sent as a binary frame."""
+
+    if encoding == ENC_JSON:
+        return (json.dumps(messagedict, default=to_json), False)
+    data = json.dumps(shorten_keys(messagedict), separators=(',', ':'))
+    if encoding == ENC_DEFLATE and len(data) >= DEFLATE_MIN_SIZE:
+        return (zlib.compress(data, DEFLATE_LEVEL), True)
+    return (data, False)
+
+
+def shorten_keys(obj):
+    """Return a copy of obj with the keys in SHORT_KEYS shortened."""
+
+    if isinstance(obj, dict):
+        return dict((SHORT_KEYS.get(k, k), shorten_keys(v))
+                    for (k, v) in obj.iteritems())
+    if isinstance(obj, (list, tuple)):
+        return [shorten_keys(v) for v in obj]
+    if isinstance(obj, (Message, Topic)):
+        return shorten_keys(to_json(obj))
+    return obj
 
 
 def message_changehandle(back, msg):
@@ -52,9 +121,13 @@ def message_changehandle(back, msg):
     newhandle = msg["handle"]
     back.users[userid].handle = newhandle
 
-    for uid in back.topics[back.users[userid].topicid].users:
-        if (uid != userid):
-            back.send_message({K_TYPE: M_CHANGEHANDLE, 'changeid': userid, 'newhandle': newhandle}, uid)
+    topicid = back.users[userid].topicid
+    back.presence.renamed(topicid, userid, newhandle)
+    # only the latest handle matters to users that are behind
+    back.broadcast(topicid, {K_TYPE: M_CHANGEHANDLE, 'changeid': userid,
+                             'newhandle': newhandle}, exclude=userid,
+                   key=(M_CHANGEHANDLE, userid))
+    back.publish('handle', topicid=topicid, userid=userid, handle=newhandle)
 
 
 def message_response(back, msg):
@@ -63,18 +136,24 @@ def message_response(back, msg):
     userid = msg["userid"]
     user = back.users[userid].handle
 
+    # the client can only reply to a message it has seen
+    t = back.load_topic(msg["topicid"])
+    if t is None or (msg["replyid"] != ROOT_PARENTID and
+                     not t.message_tree.has_message(msg["replyid"])):
+        return
+
     mnode = Message(user=user, message=msg["text"], 
                     parentid=msg["replyid"], topicid=msg["topicid"])
     # add to the message tree
-    back.topics[msg["topicid"]].add_message(mnode)
+    back.add_message(t, mnode)
     # add to the db
     back.db.add_message(mnode)
+    back.topic_index.message_added(mnode.topicid, mnode.timestamp)
 
     # notify all clients of the new message
-    sendmsg = {K_TYPE: M_NEWMESSAGE, 'message': mnode}
-
-    for uid in back.topics[back.users[userid].topicid].users:
-        back.send_message(sendmsg, uid)
+    back.broadcast(back.users[userid].topicid,
+                   {K_TYPE: M_NEWMESSAGE, 'message': mnode})
+    back.publish('message', message=mnode)
 
 
 def message_ignore(back, msg):
@@ -84,14 +163,54 @@ def message_ignore(back, msg):
 
 
 def message_settopic(back, msg):
-    back.set_topic_for_user(msg["userid"], msg["topicid"])
+    """Called when the client joins a topic.
+
+    If the client has seen the topic before (it has reconnected), it
+    sends the id of the last message it received as 'since', and only
+    gets the messages posted after that.
+    """
+
+    back.set_topic_for_user(msg["userid"], msg["topicid"], msg.get("since"))
+
+
+def message_moretree(back, msg):
+    """Called when the client wants the threads older than 'before'."""
+
+    back.send_tree_page(msg["userid"], msg["before"])
+
+
+def message_search(back, msg):
+    """Called when the client searches the messages of its topic."""
+
+    userid = msg["userid"]
+    back.send_message({K_TYPE: M_SEARCHRESULTS, 'query': msg["query"],
+                       'results': back.search(msg["query"],
+                                              back.users[userid].topicid)},
+                      userid)
+
+
+def message_getthread(back, msg):
+    """Called when the client wants the replies below message 'id'."""
+
+    back.send_thread(msg["userid"], msg["id"])
+
+
+def message_topthreads(back, msg):
+    """Called when the client wants summaries of the top threads, in
+    the order 'by'."""
+
+    back.send_top_threads(msg["userid"], msg.get("by", "activity"))
 
 
 # callbacks
 CALLBACKS = {M_RESPONSE: message_response,
              M_CHANGEHANDLE: message_changehandle,
              M_HEARTBEAT: message_ignore,
-             M_SETTOPIC: message_settopic}
+             M_SETTOPIC: message_settopic,
+             M_MORETREE: message_moretree,
+             M_SEARCH: message_search,
+             M_GETTHREAD: message_getthread,
+             M_TOPTHREADS: message_topthreads}
 
 
 class InvalidMessageError(Exception):
@@ -0,0 +1,143 @@
+"""Counters, gauges and histograms used to monitor the server.
+
+Everything is kept in module level dicts, so any module can record a
+value with e.g. metrics.incr('name') without needing a reference to the
+backend.  Each value can have labels, e.g.
+metrics.observe('on_message', t, {'mtype': 'response'}), which are kept
+as separate series of the same metric.  prometheus() returns everything
+in the Prometheus text format (served at /metrics by server.py).
+"""
+
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+# all metric names are given this prefix by prometheus()
+PREFIX = 'qanda_'
+
+# histogram bucket upper bounds for times in seconds, and for sizes
+TIME_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = tuple(4**i for i in xrange(13))
+
+# (name, labels) -> count, where labels is a sorted tuple of (label,
+# value) pairs
+_counters = {}
+# (name, labels) -> current value
+_gauges = {}
+# (name, labels) -> Histogram
+_histograms = {}
+
+
+class Histogram(object):
+    """Counts of observations by bucket, plus their number and total."""
+
+    __slots__ = ('buckets', 'counts', 'count', 'total')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.total += value
+        for (i, bound) in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+
+def _key(name, labels):
+    if not labels:
+        return (name, ())
+    return (name, tuple(sorted(labels.items())))
+
+
+def incr(name, n=1, labels=None):
+    """Increment the counter called name by n."""
+    key = _key(name, labels)
+    _counters[key] = _counters.get(key, 0) + n
+
+
+def gauge(name, value, labels=None):
+    """Set the gauge called name to value."""
+    _gauges[_key(name, labels)] = value
+
+
+def observe(name, value, labels=None, buckets=TIME_BUCKETS):
+    """Record a single timing (in seconds), or other value, in the
+    histogram called name.  buckets is only used the first time the
+    histogram is seen."""
+    key = _key(name, labels)
+    h = _histograms.get(key)
+    if h is None:
+        h = _histograms[key] = Histogram(buckets)
+    h.observe(value)
+
+
+@contextmanager
+def timer(name, labels=None):
+    """Observe the time taken by the body of a with statement."""
+    start = time.time()
+    try:
+        yield
+    finally:
+        observe(name, time.time() - start, labels)
+
+
+def timed(name, **labels):
+    """Decorator that observes the time taken by each call."""
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with timer(name, labels):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(k, str(v).replace('"', '\\"'))
+                          for (k, v) in labels) + '}'
+
+
+def prometheus():
+    """Return all the metrics in the Prometheus text exposition format."""
+
+    lines = []
+
+    def add(kind, store, fmt):
+        names = {}
+        for key in store.keys():
+            names.setdefault(key[0], []).append(key)
+        for name in sorted(names):
+            lines.append('# TYPE {0}{1} {2}'.format(PREFIX, name, kind))
+            for key in sorted(names[name]):
+                fmt(PREFIX + name, key[1], store[key])
+
+    def simple(name, labels, value):
+        lines.append('{0}{1} {2}'.format(name, _format_labels(labels),
+                                         repr(float(value))))
+
+    def histogram(name, labels, h):
+        cumulative = 0
+        for (bound, n) in zip(h.buckets, h.counts):
+            cumulative += n
+            lines.append('{0}_bucket{1} {2}'.format(
+                name, _format_labels(labels + (('le', repr(float(bound))),)),
+                cumulative))
+        lines.append('{0}_bucket{1} {2}'.format(
+            name, _format_labels(labels + (('le', '+Inf'),)), h.count))
+        lines.append('{0}_sum{1} {2}'.format(name, _format_labels(labels),
+                                             repr(h.total)))
+        lines.append('{0}_count{1} {2}'.format(name, _format_labels(labels),
+                                               h.count))
+
+    add('counter', _counters, simple)
+    add('gauge', _gauges, simple)
+    add('histogram', _histograms, histogram)
+    return '\n'.join(lines) + '\n'
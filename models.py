@@ -1,9 +1,23 @@
 """Data structures used in the backend."""
 
+import heapq
+import time
 import uuid
+import calendar
 import datetime
+from array import array
 
 from settings import *
+from ids import IdAllocator
+from search import SearchIndex, message_text
+
+# a single copy of each user handle is shared by all the messages
+# posted under it
+_handles = {}
+
+def intern_handle(handle):
+    """Return the shared copy of the string handle."""
+    return _handles.setdefault(handle, handle)
 
 # users are not persistent at the moment, i.e. they are not stored in
 # the database
@@ -14,18 +28,30 @@ class User(object):
     handle     - username
     auth_token - an unique authentication token that the client needs
                  to send with every message
+    encoding   - the wire encoding of messages sent to the user (one
+                 of message.ENCODINGS)
+    bytes_sent - number of bytes sent to the user so far
+    outbound   - the queue of messages waiting to be sent to the user
     """
 
+    __slots__ = ('userid', 'handle', 'auth_token', 'topicid', 'encoding',
+                 'bytes_sent', 'outbound', '_handler')
+
     NO_TOPIC = -1
-    nusers = 0 # number of users created so far (used as id)
+    # hands out the user ids
+    ids = IdAllocator()
 
     def __init__(self):
-        self.userid = self.nusers
+        self.userid = User.ids.allocate()
         self.handle = 'user{0}'.format(self.userid)
         self.auth_token = str(uuid.uuid4())
         # the current topic id of the user
         self.topicid = User.NO_TOPIC
-        User.nusers += 1
+        self.encoding = 'json'
+        self.bytes_sent = 0
+        self.outbound = None
+        # the websocket handler of the user
+        self._handler = None
 
 
 class Topic(object):
@@ -35,33 +61,43 @@ class Topic(object):
     name    - the full name of the topic
     """
 
+    __slots__ = ('id', 'name', 'nusers', 'message_tree', 'snapshot',
+                 'snapshot_version', 'users', 'remote_users')
+
     # retured as topic id if the topic doesnt exist
     NOID = -1
-    # number of topics created so far (used as id)
-    ntopics = 0 
+    # hands out the ids of new topics
+    ids = IdAllocator()
 
     def __init__(self, name, id=None):
         if id is None:
-            self.id = Topic.ntopics
+            self.id = Topic.ids.allocate()
         else:
             self.id = id
         self.name = name
         self.nusers = 0
-        Topic.ntopics += 1
         
-        # tree of all messages for this topic
+        # tree of all messages for this topic (None if the messages
+        # have not been loaded from the db)
         self.message_tree = MessageTree([])
+        # the page of newest threads that is sent to users as they
+        # join, encoded for each wire encoding, and the message tree
+        # version it was built from
+        self.snapshot = {}
+        self.snapshot_version = None
 
         # mapping of userids to user objects for this topic
         self.users = {}
+        # mapping of userids to handles for the users in this topic that
+        # are connected to other server processes
+        self.remote_users = {}
 
-    def add_user(self, userid):
-        # we only store the ids here
-        self.users[userid] = None
+    def add_user(self, user):
+        self.users[user.userid] = user
         self.nusers += 1
 
     def add_message(self, mnode):
-        self.message_tree.add_message(mnode)
+        return self.message_tree.add_message(mnode)
 
     def remove_user(self, userid):
         del self.users[userid]
@@ -70,62 +106,305 @@ class Topic(object):
     def get_all_messages(self):
         return self.message_tree.get_all_messages()
 
+    def unload(self):
+        """Free the memory used by the messages of this topic."""
+        self.message_tree = None
+        self.snapshot = {}
+        self.snapshot_version = None
+
+    def get_page(self, before=None, nthreads=20, max_depth=None):
+        return self.message_tree.get_page(before, nthreads, max_depth)
+
+    def get_messages_since(self, msgid):
+        return self.message_tree.get_messages_since(msgid)
+
 class Message(object):
+    """A message posted to a topic.  The post time is kept as whole
+    seconds since the epoch in timestamp."""
+
+    __slots__ = ('user', 'message', 'id', 'topicid', 'parentid', 'timestamp')
 
-    # number of messages created so far (used as id)
-    nmessages = 0
+    # hands out the ids of new messages
+    ids = IdAllocator()
 
     def __init__(self, user, message, parentid, posttime=None, topicid=None, id=None):
-        self.user = user
+        self.user = intern_handle(user)
         self.message = message
-        self.id = Message.nmessages if id is None else id
+        self.id = Message.ids.allocate() if id is None else id
         self.topicid = Topic.NOID if topicid is None else topicid
         self.parentid = parentid
         if posttime is None:
-            self.posttime = datetime.datetime.now()
-        elif isinstance(posttime, str):
-            # convert to datetime object
-            self.posttime = datetime.datetime.strptime(posttime, DATE_FORMAT)
+            self.timestamp = int(time.time())
+        elif isinstance(posttime, (int, long)):
+            self.timestamp = posttime
+        elif isinstance(posttime, basestring):
+            self.timestamp = int(time.mktime(
+                time.strptime(posttime, DATE_FORMAT)))
+        elif posttime.tzinfo is not None:
+            self.timestamp = calendar.timegm(posttime.utctimetuple())
         else:
-            self.posttime = posttime
-        Message.nmessages += 1
-        
+            self.timestamp = int(time.mktime(posttime.timetuple()))
+
+    @property
+    def posttime(self):
+        """The post time as a datetime in the local time of the server."""
+        return datetime.datetime.fromtimestamp(self.timestamp)
+
 
 class MessageTree(object):
-    """Class to store all messages for a particular topic."""
+    """Class to store all messages for a particular topic.
+
+    Each message has a position, the order in which it was added to
+    the tree (so a parent always comes before its children).  The
+    shape of the tree is kept in arrays indexed by position, along
+    with the depth of each message (0 for a root message), the number
+    of messages below it, and the time of the newest message in its
+    subtree, which are all brought up to date as messages are added.
+    """
 
     # a message with parentid of _PARENTID_ROOT is a root message
     _PARENTID_ROOT = -1
+    # marks the end of a list of children in the arrays
+    _NONE = -1
+
+    # orders of the threads returned by top_threads
+    BY_ACTIVITY = 'activity'  # newest message in the thread
+    BY_SIZE = 'size'          # most messages
+    BY_NEW = 'new'            # newest root message
+    ORDERS = [BY_ACTIVITY, BY_SIZE, BY_NEW]
 
     def __init__(self, messages=[]):
         
         # store ids of the root nodes (in the correct display order)
-        self._rootnodes = []
-        # key is the node id, value is a list of children node ids (in
-        # the correct display order)
-        self._children = {}
-        # keys are the node ids, values are the actual MessageNode objects
-        self._messages = {}
+        self._rootnodes = array('l')
+        # position of each root node id in _rootnodes
+        self._rootindex = {}
+        # the message objects, and their ids, by position
+        self._messages = []
+        self._order = array('l')
+        # position of each message id
+        self._position = {}
+        # positions of the first and last child of each message, and
+        # of the next message with the same parent
+        self._firstchild = array('l')
+        self._lastchild = array('l')
+        self._nextsibling = array('l')
+        # position of the parent of each message (_NONE for a root)
+        self._parent = array('l')
+        # depth, number of descendants, and the latest timestamp of the
+        # message and its descendants, of each message
+        self._depth = array('l')
+        self._ndescendants = array('l')
+        self._activity = array('l')
+        # incremented every time the tree changes
+        self.version = 0
+        # index of the words in the messages, by position (None until
+        # the tree is first searched)
+        self._search = None
+        # replies whose parents are not in the tree yet, by parent id
+        self._orphans = {}
 
         for msg in messages:
             self.add_message(msg)
 
     def add_message(self, mnode):
+        """Add mnode to the tree, and return the list of messages added.
+
+        Messages from the db, or from another server process, can come
+        before their parents, so a reply whose parent is not in the tree
+        is held back, and added along with the parent when it comes.
+        """
+
+        if (mnode.parentid != self._PARENTID_ROOT and
+            mnode.parentid not in self._position):
+            self._orphans.setdefault(mnode.parentid, []).append(mnode)
+            return []
+        added = []
+        stack = [mnode]
+        while stack:
+            mnode = stack.pop()
+            self._place(mnode)
+            added.append(mnode)
+            stack.extend(reversed(self._orphans.pop(mnode.id, [])))
+        return added
+
+    def has_message(self, msgid):
+        return msgid in self._position
+
+    def _place(self, mnode):
         mnodeid = mnode.id
         parentid = mnode.parentid
+        pos = len(self._order)
         if parentid == self._PARENTID_ROOT:
+            self._rootindex[mnodeid] = len(self._rootnodes)
             self._rootnodes.append(mnodeid)
+            ppos = self._NONE
+            self._depth.append(0)
         else:
-            self._children[parentid].append(mnodeid)
-        self._children[mnodeid] = []
-        self._messages[mnodeid] = mnode
+            ppos = self._position[parentid]
+            last = self._lastchild[ppos]
+            if last == self._NONE:
+                self._firstchild[ppos] = pos
+            else:
+                self._nextsibling[last] = pos
+            self._lastchild[ppos] = pos
+            self._depth.append(self._depth[ppos] + 1)
+        self._parent.append(ppos)
+        self._ndescendants.append(0)
+        self._activity.append(mnode.timestamp)
+        # every message above this one has one more descendant
+        while ppos != self._NONE:
+            self._ndescendants[ppos] += 1
+            if mnode.timestamp > self._activity[ppos]:
+                self._activity[ppos] = mnode.timestamp
+            ppos = self._parent[ppos]
+        self._messages.append(mnode)
+        self._order.append(mnodeid)
+        self._position[mnodeid] = pos
+        self._firstchild.append(self._NONE)
+        self._lastchild.append(self._NONE)
+        self._nextsibling.append(self._NONE)
+        self.version += 1
+        if self._search is not None:
+            self._search.add(pos, message_text(mnode))
 
-        return mnode
+    def __len__(self):
+        return len(self._messages)
+
+    def _children_of(self, pos):
+        """Return the list of child ids of the message at pos."""
+        children = []
+        child = self._firstchild[pos]
+        while child != self._NONE:
+            children.append(self._order[child])
+            child = self._nextsibling[child]
+        return children
 
     def get_all_messages(self):
-        return {'rootnodes': self._rootnodes, 
-                'children': self._children, 
-                'messages': self._messages}
+        return {'rootnodes': list(self._rootnodes), 
+                'children': dict((mid, self._children_of(pos))
+                                 for (pos, mid) in enumerate(self._order)),
+                'messages': dict((m.id, m) for m in self._messages)}
+
+    def _collect(self, rootnodes, max_depth=None):
+        """Return the messages in the threads below the messages with
+        ids rootnodes, in the form of get_all_messages, going at most
+        max_depth levels down (all the way if None).  'truncated' has
+        the number of replies to each message whose replies were left
+        out."""
+
+        children = {}
+        messages = {}
+        truncated = {}
+        stack = [(mid, 0) for mid in rootnodes]
+        while stack:
+            (mid, depth) = stack.pop()
+            pos = self._position[mid]
+            messages[mid] = self._messages[pos]
+            if max_depth is not None and depth >= max_depth:
+                children[mid] = []
+                if self._firstchild[pos] != self._NONE:
+                    truncated[mid] = len(self._children_of(pos))
+                continue
+            children[mid] = self._children_of(pos)
+            stack.extend((cid, depth + 1) for cid in children[mid])
+        return {'rootnodes': list(rootnodes),
+                'children': children,
+                'messages': messages,
+                'truncated': truncated}
+
+    def get_page(self, before=None, nthreads=20, max_depth=None):
+        """Return the newest nthreads root threads that are older than
+        the root node before (or the newest threads if before is None),
+        each going max_depth levels below its root message.
+
+        The page has the same form as _collect, plus 'more', which is
+        True if there are older threads still to fetch, and 'last',
+        which is the id of the newest message in the tree.
+        """
+
+        if before is None:
+            end = len(self._rootnodes)
+        else:
+            end = self._rootindex.get(before, 0)
+        start = max(0, end - nthreads)
+        page = self._collect(self._rootnodes[start:end], max_depth)
+        page['more'] = start > 0
+        page['last'] = self._order[-1] if self._order else None
+        return page
+
+    def get_subtree(self, msgid, max_depth=None):
+        """Return the message msgid and the messages below it, going
+        at most max_depth levels down, in the form of _collect (or None
+        if msgid is not in the tree)."""
+
+        if msgid not in self._position:
+            return None
+        return self._collect([msgid], max_depth)
+
+    def get_stats(self, msgid):
+        """Return (depth, number of descendants, latest timestamp in
+        the subtree) of the message msgid."""
+
+        pos = self._position[msgid]
+        return (self._depth[pos], self._ndescendants[pos],
+                self._activity[pos])
+
+    def top_threads(self, k, by=BY_ACTIVITY):
+        """Return summaries of the first k threads in the order by (one
+        of ORDERS), as dicts with the root message, the number of
+        replies in the thread and the time of the latest message."""
+
+        if by == self.BY_SIZE:
+            key = lambda pos: (self._ndescendants[pos], pos)
+        elif by == self.BY_ACTIVITY:
+            key = lambda pos: (self._activity[pos], pos)
+        else:
+            key = None
+        positions = heapq.nlargest(k, (self._position[mid]
+                                       for mid in self._rootnodes), key=key)
+        return [{'message': self._messages[pos],
+                 'replies': self._ndescendants[pos],
+                 'lastactivity': time.strftime(
+                     DATE_FORMAT, time.localtime(self._activity[pos]))}
+                for pos in positions]
+
+    def get_messages_since(self, msgid):
+        """Return a list of the messages added after msgid, parents
+        before children, or None if msgid is not in the tree."""
+
+        pos = self._position.get(msgid)
+        if pos is None:
+            return None
+        return self._messages[pos + 1:]
+
+    def search(self, query, limit=20):
+        """Return (score, message) for the best limit messages that
+        contain all the words in query (see search.py), best first."""
+
+        if self._search is None:
+            self._search = SearchIndex()
+            for (pos, mnode) in enumerate(self._messages):
+                self._search.add(pos, message_text(mnode))
+        return [(score, self._messages[pos])
+                for (score, pos) in self._search.search(query, limit)]
+
+    def get_message(self, msgid):
+        pos = self._position.get(msgid)
+        return None if pos is None else self._messages[pos]
+
+    def get_thread(self, msgid):
+        """Return the list of messages from the root of the thread of
+        msgid down to the parent of msgid."""
+
+        thread = []
+        mnode = self.get_message(msgid)
+        while mnode is not None and mnode.parentid != self._PARENTID_ROOT:
+            mnode = self.get_message(mnode.parentid)
+            if mnode is not None:
+                thread.append(mnode)
+        thread.reverse()
+        return thread
 
 
 def to_json(pyo):
@@ -135,7 +414,8 @@ def to_json(pyo):
                 'message': pyo.message,
                 'id': pyo.id,
                 'parentid': pyo.parentid,
-                'posttime': pyo.posttime.strftime(DATE_FORMAT),
+                'posttime': time.strftime(DATE_FORMAT,
+                                          time.localtime(pyo.timestamp)),
                 'topicid': pyo.topicid}
     elif isinstance(pyo, Topic):
         return {'id': pyo.id,
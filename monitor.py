@@ -0,0 +1,92 @@
+"""Watch the health of the running server process.
+
+LagMonitor measures how late the IOLoop runs callbacks, which is how
+long every client waits behind whatever the server is busy with.
+SamplingProfiler records where the process spends its time, by taking
+the Python stack at regular intervals of CPU time; it can be started
+and stopped while the server runs (see ProfileHandler in server.py).
+"""
+
+import signal
+import time
+
+import tornado.ioloop
+
+import metrics
+
+
+class LagMonitor(object):
+    """Schedule a callback every interval seconds and record how late
+    it runs, in the ioloop_lag histogram and the ioloop_lag_latest
+    gauge."""
+
+    def __init__(self, interval, io_loop=None):
+        self.interval = interval
+        self.io_loop = io_loop or tornado.ioloop.IOLoop.instance()
+        self._timeout = None
+
+    def start(self):
+        self._schedule()
+
+    def stop(self):
+        if self._timeout is not None:
+            self.io_loop.remove_timeout(self._timeout)
+            self._timeout = None
+
+    def _schedule(self):
+        due = time.time() + self.interval
+        self._timeout = self.io_loop.add_timeout(due, lambda: self._run(due))
+
+    def _run(self, due):
+        lag = max(0.0, time.time() - due)
+        metrics.gauge('ioloop_lag_latest', lag)
+        metrics.observe('ioloop_lag', lag)
+        self._schedule()
+
+
+class SamplingProfiler(object):
+    """Count the stacks seen every interval seconds of CPU time.
+
+    Uses SIGPROF, so it must be started from the main thread.
+    """
+
+    def __init__(self, interval=0.005, maxdepth=50):
+        self.interval = interval
+        self.maxdepth = maxdepth
+        # stack (a tuple of 'file:function' strings, outermost first)
+        # -> number of samples
+        self.stacks = {}
+        self.running = False
+
+    def start(self):
+        if self.running:
+            return
+        signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        self.running = True
+
+    def stop(self):
+        if not self.running:
+            return
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_IGN)
+        self.running = False
+
+    def reset(self):
+        self.stacks = {}
+
+    def _sample(self, signum, frame):
+        stack = []
+        while frame is not None and len(stack) < self.maxdepth:
+            code = frame.f_code
+            stack.append('{0}:{1}'.format(code.co_filename, code.co_name))
+            frame = frame.f_back
+        stack = tuple(reversed(stack))
+        self.stacks[stack] = self.stacks.get(stack, 0) + 1
+
+    def collapsed(self):
+        """Return the samples in the collapsed stack format read by
+        flame graph tools: one 'outer;...;inner count' line per stack."""
+        return ''.join('{0} {1}\n'.format(';'.join(stack), n)
+                       for (stack, n) in sorted(self.stacks.items(),
+                                                key=lambda s: -s[1]))
@@ -0,0 +1,127 @@
+"""Per connection queues of frames waiting to be sent.
+
+Writing to a websocket never blocks: Tornado buffers whatever the
+client has not read yet.  So that a slow client can not make us buffer
+without limit, each connection writes to the socket only when its
+previous writes have drained, and in the meantime keeps frames in an
+OutboundQueue.  Queued frames with the same key are coalesced (only the
+newest is sent), and a connection that stays over its high water mark
+for too long is given up on.
+"""
+
+import time
+from collections import deque
+
+from tornado.ioloop import IOLoop
+from tornado.iostream import StreamClosedError
+from tornado.websocket import WebSocketClosedError
+
+import metrics
+
+
+class OutboundQueue(object):
+    """Frames waiting to be written to the websocket handler."""
+
+    def __init__(self, handler, high_water, grace, overflow):
+        """overflow() is called if more than high_water bytes have been
+        waiting for longer than grace seconds.  It is called from the
+        IOLoop rather than from put(), which may be in the middle of a
+        loop over the users that overflow() removes one from."""
+
+        self.handler = handler
+        self.high_water = high_water
+        self.grace = grace
+        self._overflow = overflow
+        # [key, frame] for each queued frame, oldest first, and the
+        # entries that have a key, by key
+        self._frames = deque()
+        self._keyed = {}
+        # bytes in _frames, and bytes written that have not drained
+        self.queued_bytes = 0
+        self.writing_bytes = 0
+        # when we went over the high water mark (None if we are under it)
+        self._over_since = None
+        self.closed = False
+
+    def __len__(self):
+        return len(self._frames)
+
+    @property
+    def buffered_bytes(self):
+        return self.queued_bytes + self.writing_bytes
+
+    def put(self, frame, key=None):
+        """Send frame, a (data, binary) pair from message.encode.  If a
+        frame with the same key is still queued it is replaced."""
+
+        if self.closed:
+            return
+        if not self._frames and self._drained():
+            self._write([frame])
+            return
+
+        entry = self._keyed.get(key) if key is not None else None
+        if entry is not None:
+            self.queued_bytes += len(frame[0]) - len(entry[1][0])
+            entry[1] = frame
+            metrics.incr('outbound_coalesced')
+        else:
+            entry = [key, frame]
+            self._frames.append(entry)
+            if key is not None:
+                self._keyed[key] = entry
+            self.queued_bytes += len(frame[0])
+        if self._drained():
+            self._on_drain()
+        else:
+            self.check()
+
+    def check(self, now=None):
+        """Send the queued frames if the earlier ones have drained, and
+        call overflow() if we have been over the high water mark for
+        longer than the grace period."""
+
+        if self.writing_bytes and self._drained():
+            self._on_drain()
+        if self.buffered_bytes <= self.high_water:
+            self._over_since = None
+            return
+        now = time.time() if now is None else now
+        if self._over_since is None:
+            self._over_since = now
+        elif now - self._over_since > self.grace and not self.closed:
+            self.close()
+            metrics.incr('outbound_overflows')
+            IOLoop.current().add_callback(self._overflow)
+
+    def close(self):
+        """Forget all queued frames; nothing more will be sent."""
+        self.closed = True
+        self._frames.clear()
+        self._keyed.clear()
+        self.queued_bytes = 0
+
+    def _drained(self):
+        return not self.writing_bytes or not self.handler.stream.writing()
+
+    def _write(self, frames):
+        try:
+            for (data, binary) in frames:
+                self.handler.write_message(data, binary=binary)
+                self.writing_bytes += len(data)
+            # called once everything written so far has gone, unless
+            # a later write (a pong, say) replaces the callback; put()
+            # and check() see that the stream is idle in that case
+            self.handler.stream.write(b'', self._on_drain)
+        except (WebSocketClosedError, StreamClosedError):
+            self.close()
+
+    def _on_drain(self):
+        self.writing_bytes = 0
+        self._over_since = None
+        if self._frames and not self.closed:
+            frames = [frame for (key, frame) in self._frames]
+            self._frames.clear()
+            self._keyed.clear()
+            self.queued_bytes = 0
+            self._write(frames)
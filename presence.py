@@ -0,0 +1,97 @@
+"""Tell the users in each topic who else is there.
+
+A user joining a topic is sent everyone already in it as a single
+roster message.  Everyone else hears about arrivals and departures in
+batches: the changes to each topic are collected, and every flush
+interval each topic that has changed gets one presence message with
+the users that joined and left since the last one.  A user that joins
+and leaves within an interval is never announced at all, unless a
+newcomer was sent them in a roster meanwhile.
+
+Clients apply rosters and presence messages idempotently, since a user
+can be both in the roster a newcomer is sent and in the next presence
+message.
+"""
+
+from collections import OrderedDict
+
+from tornado.ioloop import PeriodicCallback
+
+import message
+import metrics
+
+
+class Presence(object):
+
+    def __init__(self, backend, interval):
+        """Presence messages are sent with backend.broadcast every
+        interval seconds."""
+
+        self.backend = backend
+        # topicid -> OrderedDict of the users that have changed since
+        # the last flush: userid -> handle for users that joined, or
+        # None for users that left
+        self._pending = {}
+        # topicid -> the users that joined since the last flush and have
+        # not been in anyone's roster
+        self._unseen = {}
+        self._flusher = PeriodicCallback(self.flush, interval * 1000)
+
+    def start(self):
+        self._flusher.start()
+
+    def stop(self):
+        self._flusher.stop()
+
+    def roster(self, t, exclude=None):
+        """Return everyone in topic t, on this process or another, except
+        the user exclude."""
+
+        roster = [{'userid': uid, 'handle': user.handle}
+                  for (uid, user) in t.users.iteritems() if uid != exclude]
+        roster.extend({'userid': uid, 'handle': handle}
+                      for (uid, handle) in t.remote_users.iteritems())
+        unseen = self._unseen.get(t.id)
+        if unseen:
+            unseen.difference_update(r['userid'] for r in roster)
+        return roster
+
+    def joined(self, topicid, userid, handle):
+        self._pending.setdefault(topicid, OrderedDict())[userid] = handle
+        self._unseen.setdefault(topicid, set()).add(userid)
+
+    def left(self, topicid, userid):
+        changes = self._pending.setdefault(topicid, OrderedDict())
+        unseen = self._unseen.get(topicid, ())
+        if changes.get(userid) is not None and userid in unseen:
+            # joined since the last flush, nobody has heard of them
+            del changes[userid]
+            unseen.discard(userid)
+        else:
+            changes[userid] = None
+
+    def renamed(self, topicid, userid, handle):
+        """A user changed handle (which is sent on by itself); if the
+        user's arrival has not been announced yet, announce the new
+        handle."""
+
+        changes = self._pending.get(topicid)
+        if changes and changes.get(userid) is not None:
+            changes[userid] = handle
+
+    def flush(self):
+        """Send the changes to each topic since the last flush."""
+
+        pending, self._pending = self._pending, {}
+        self._unseen = {}
+        for (topicid, changes) in pending.iteritems():
+            if not changes:
+                continue
+            joined = [{'userid': uid, 'handle': handle}
+                      for (uid, handle) in changes.iteritems()
+                      if handle is not None]
+            left = [uid for (uid, handle) in changes.iteritems()
+                    if handle is None]
+            self.backend.broadcast(topicid, {message.K_TYPE: message.M_PRESENCE,
+                                             'joined': joined, 'left': left})
+            metrics.incr('presence_changes', len(changes))
@@ -0,0 +1,52 @@
+"""Token bucket rate limits, to stop a client flooding the server.
+
+A bucket holds up to burst tokens and gains rate tokens a second; each
+frame takes a token, and frames that find the bucket empty are
+rejected.
+"""
+
+import time
+
+import metrics
+
+
+class TokenBucket(object):
+
+    __slots__ = ('tokens', 'stamp')
+
+    def __init__(self, tokens, stamp):
+        self.tokens = tokens
+        # when tokens was last brought up to date
+        self.stamp = stamp
+
+
+class RateLimiter(object):
+    """A token bucket for each key (e.g. a userid or a topicid)."""
+
+    def __init__(self, name, rate, burst):
+        """Rejections are counted by the metric 'throttled_' + name."""
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self._metric = 'throttled_' + name
+        self._buckets = {}
+
+    def allow(self, key, now=None):
+        """Take a token from the bucket of key; return False (and count
+        it) if there are none."""
+
+        now = time.time() if now is None else now
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(self.burst, now)
+        else:
+            bucket.tokens = min(self.burst, bucket.tokens +
+                                (now - bucket.stamp) * self.rate)
+            bucket.stamp = now
+        if bucket.tokens < 1:
+            metrics.incr(self._metric)
+            return False
+        bucket.tokens -= 1
+        return True
+
+    def forget(self, key):
+        self._buckets.pop(key, None)
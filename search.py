@@ -0,0 +1,84 @@
+"""Full text search of messages.
+
+A SearchIndex maps each word to the documents (messages, identified by
+an integer key) that contain it.  A query finds the documents that
+contain every word of the query, ranked by how often they use the
+words, with rare words counting for more; ties go to the newest
+document (the one with the largest key).  Words are runs of letters and
+digits, compared in lower case, which matches the 'simple' text search
+configuration used by PostgresDb.
+"""
+
+import heapq
+import math
+import re
+from array import array
+from collections import Counter
+
+_WORD = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(text):
+    """Return the list of words in text, in lower case."""
+    return _WORD.findall(text.lower())
+
+
+def message_text(msg):
+    """Return the searchable text of a message: its author and body."""
+    return u'{0} {1}'.format(msg.user, msg.message)
+
+
+class SearchIndex(object):
+
+    def __init__(self):
+        # word -> keys of the documents that contain it, with a key
+        # repeated for each time the document uses the word
+        self._postings = {}
+        self._ndocs = 0
+
+    def __len__(self):
+        return self._ndocs
+
+    def add(self, key, text):
+        words = tokenize(text)
+        if not words:
+            return
+        self._ndocs += 1
+        for word in words:
+            postings = self._postings.get(word)
+            if postings is None:
+                postings = self._postings[word] = array('l')
+            postings.append(key)
+
+    def search(self, query, limit, accept=None):
+        """Return (score, key) for the best limit documents that contain
+        all the words in query, best first.  If accept is given, only
+        documents whose key it returns True for are included."""
+
+        words = set(tokenize(query))
+        if not words:
+            return []
+        postings = []
+        for word in words:
+            if word not in self._postings:
+                return []
+            postings.append(self._postings[word])
+
+        # start from the rarest word, so that there are fewest
+        # candidates to check against the others
+        postings.sort(key=len)
+        scores = None
+        for keys in postings:
+            counts = Counter(keys)
+            idf = math.log(1.0 + self._ndocs / float(len(counts)))
+            if scores is None:
+                scores = dict((key, n * idf) for (key, n) in counts.iteritems()
+                              if accept is None or accept(key))
+            else:
+                scores = dict((key, score + counts[key] * idf)
+                              for (key, score) in scores.iteritems()
+                              if key in counts)
+            if not scores:
+                return []
+        return heapq.nlargest(limit, ((score, key)
+                                      for (key, score) in scores.iteritems()))
@@ -1,37 +1,151 @@
 """Tornado WebSockets server for the q&a app."""
 
+import datetime
+import email.utils
+import hashlib
+import json
 import os
+import signal
+import sys
+import urllib
 import urlparse
 
 import tornado.websocket
 import tornado.httpserver
 import tornado.ioloop
+import tornado.log
+import tornado.netutil
+import tornado.process
 import tornado.web
 
 import backend
-from settings import DEBUG
+import bus
+import db
+import message
+import metrics
+import models
+import monitor
+import topicindex
+from settings import (DEBUG, DB_DROP, NUM_PROCESSES, BUS_PORT, LAG_INTERVAL,
+                      PROFILER_ENABLED, PROFILER_INTERVAL, LOBBY_PAGE_SIZE,
+                      IDLE_TIMEOUT)
 
-# the backend handles all application logic
-_backend = backend.BackEnd()
+# the backend handles all application logic (it is created below, once
+# any worker processes have been started)
+_backend = None
+
+def search_topics(handler):
+    """Search the topics with the query arguments of the request:
+    q (the text to look for), match, sort and page.  Returns a dict with
+    the arguments, the total number of matches and the page of topics."""
+
+    args = {'q': handler.get_argument('q', ''),
+            'match': handler.get_argument('match', topicindex.MATCH_PREFIX),
+            'sort': handler.get_argument('sort', topicindex.SORT_NEW)}
+    try:
+        page = int(handler.get_argument('page', 0))
+    except ValueError:
+        raise tornado.web.HTTPError(400)
+    if (args['match'] not in topicindex.MATCHES or
+        args['sort'] not in topicindex.SORTS or page < 0):
+        raise tornado.web.HTTPError(400)
+    (total, topics) = _backend.topic_index.search(
+        args['q'], args['match'], args['sort'],
+        page * LOBBY_PAGE_SIZE, LOBBY_PAGE_SIZE)
+    return {'args': args, 'page': page, 'total': total, 'topics': topics}
 
 class LobbyHandler(tornado.web.RequestHandler):
+    # the rendered first page of topics, the topics version it was
+    # rendered from, and the ETag of the lobby page that contains it
+    _topiclist = None
+    _topiclist_version = None
+    _etag = None
+
     def get(self):
-        return self._render()
+        if self.request.query:
+            # a search; these pages are not cached
+            self.set_header('Cache-Control', 'no-cache')
+            with metrics.timer('render', {'page': 'topiclist'}):
+                topiclist = self._render_topiclist(search_topics(self))
+            return self._render(topiclist)
+
+        self._update_topiclist()
+        last_modified = datetime.datetime.utcfromtimestamp(
+            int(_backend.topics_modified))
+        # browsers must check with us before using their copy
+        self.set_header('Cache-Control', 'no-cache')
+        self.set_header('Etag', LobbyHandler._etag)
+        self.set_header('Last-Modified', last_modified)
+        if self._not_modified(last_modified):
+            self.set_status(304)
+            return
+        return self._render(LobbyHandler._topiclist)
 
     def post(self):
         # get name of topic to add
         tname = self._get_topic_name()
         if tname:
             added = _backend.add_topic(tname)
-        self._render(**{'error': not added, 'topicname': tname})
+        self.set_header('Cache-Control', 'no-store')
+        self._update_topiclist()
+        self._render(LobbyHandler._topiclist,
+                     **{'error': not added, 'topicname': tname})
+
+    def _not_modified(self, last_modified):
+        """Return True if the browser's copy of the page is current."""
+        etags = self.request.headers.get('If-None-Match')
+        if etags is not None:
+            return LobbyHandler._etag in etags or etags.strip() == '*'
+        since = self.request.headers.get('If-Modified-Since')
+        if since is not None:
+            since = email.utils.parsedate(since)
+            return (since is not None and
+                    datetime.datetime(*since[:6]) >= last_modified)
+        return False
 
-    def _render(self, **kwargs):
-        kwargs['topics'] = _backend.get_topics()
+    def _update_topiclist(self):
+        """Render the first page of topics again if any have been added."""
+        version = _backend.topics_version
+        if LobbyHandler._topiclist_version == version:
+            return
+        (total, topics) = _backend.topic_index.search(limit=LOBBY_PAGE_SIZE)
+        with metrics.timer('render', {'page': 'topiclist'}):
+            topiclist = self._render_topiclist(
+                {'args': {'q': '', 'match': topicindex.MATCH_PREFIX,
+                          'sort': topicindex.SORT_NEW},
+                 'page': 0, 'total': total, 'topics': topics})
+        LobbyHandler._topiclist = topiclist
+        LobbyHandler._topiclist_version = version
+        # the same topics give the same ETag in every server process
+        LobbyHandler._etag = '"{0}"'.format(
+            hashlib.sha1(topiclist).hexdigest())
+
+    def _render_topiclist(self, result):
+        """Render a page of search_topics results."""
+        def link(page):
+            return '/?' + urllib.urlencode(
+                dict(result['args'], page=page,
+                     q=result['args']['q'].encode('utf-8')))
+        npages = (result['total'] + LOBBY_PAGE_SIZE - 1) // LOBBY_PAGE_SIZE
+        return self.render_string(
+            'topiclist.html', topics=result['topics'], total=result['total'],
+            prevpage=link(result['page'] - 1) if result['page'] > 0 else None,
+            nextpage=(link(result['page'] + 1)
+                      if result['page'] + 1 < npages else None))
+
+    def _render(self, topiclist, **kwargs):
+        kwargs['topiclist'] = topiclist
+        kwargs['q'] = self.get_argument('q', '')
+        kwargs['sort'] = self.get_argument('sort', topicindex.SORT_NEW)
+        kwargs['match'] = self.get_argument('match', topicindex.MATCH_PREFIX)
+        kwargs['sorts'] = topicindex.SORTS
+        kwargs['matches'] = topicindex.MATCHES
         if 'error' not in kwargs:
             kwargs['error'] = False
         if 'topicname' not in kwargs:
             kwargs['topicname'] = 'meaning of life'
-        self.render('index.html', **kwargs)
+        with metrics.timer('render', {'page': 'lobby'}):
+            self.render('index.html', **kwargs)
 
     def _get_topic_name(self):
         """Return topic name to add from raw data, or None if postdata invalid."""
@@ -41,16 +155,48 @@ class LobbyHandler(tornado.web.RequestHandler):
             tname = None
         return tname
 
-    def set_extra_headers(self, path):
-        """Disable caching."""
-        self.set_header('Cache-Control', 
-                        'no-store, no-cache, must-revalidate, max-age=0')
+class TopicsHandler(tornado.web.RequestHandler):
+    """Search the topics, returning JSON (see search_topics)."""
+    def get(self):
+        result = search_topics(self)
+        self.write({'total': result['total'],
+                    'page': result['page'],
+                    'pagesize': LOBBY_PAGE_SIZE,
+                    'topics': [{'id': t.id, 'name': t.name,
+                                'nusers': t.nusers + len(t.remote_users),
+                                'nmessages':
+                                _backend.topic_index.nmessages(t.id)}
+                               for t in result['topics']]})
+
+class SearchHandler(tornado.web.RequestHandler):
+    """Search the messages for the words in q, in the topic with id
+    topic, or in all topics, returning JSON (see BackEnd.search)."""
+    def get(self):
+        query = self.get_argument('q')
+        topicid = self.get_argument('topic', None)
+        if topicid is not None:
+            try:
+                topicid = int(topicid)
+            except ValueError:
+                raise tornado.web.HTTPError(400)
+            if _backend.get_topic_from_id(topicid) is None:
+                raise tornado.web.HTTPError(404)
+        results = _backend.search(query, topicid)
+        for r in results:
+            r['topic'] = _backend.topics[r['topicid']].name
+        self.set_header('Content-Type', 'application/json; charset=UTF-8')
+        self.write(json.dumps({'query': query, 'results': results},
+                              default=models.to_json))
 
 class QaHandler(tornado.web.RequestHandler):
     def get(self, slug):
-        t = _backend.get_topic_from_id(int(slug))
+        # load the messages now, ready for when the websocket connects
+        t = _backend.load_topic(int(slug))
+        if t is None:
+            raise tornado.web.HTTPError(404)
 
-        self.render('qa.html', topic=t)
+        with metrics.timer('render', {'page': 'qa'}):
+            self.render('qa.html', topic=t)
 
     def set_extra_headers(self, path):
         """Disable caching."""
@@ -63,26 +209,110 @@ class MyStaticFileHandler(tornado.web.StaticFileHandler):
         self.set_header('Cache-Control', 
                         'no-store, no-cache, must-revalidate, max-age=0')
 
+class MetricsHandler(tornado.web.RequestHandler):
+    """The metrics of this process, in the Prometheus text format."""
+    def get(self):
+        self.set_header('Content-Type', 'text/plain; version=0.0.4')
+        self.write(metrics.prometheus())
+
+class ProfileHandler(tornado.web.RequestHandler):
+    """Control the sampling profiler (if PROFILER_ENABLED is set).
+
+    GET returns the samples so far as collapsed stacks; POST with
+    action=start, stop or reset controls the profiler.
+    """
+
+    profiler = monitor.SamplingProfiler(PROFILER_INTERVAL)
+
+    def prepare(self):
+        if not PROFILER_ENABLED:
+            raise tornado.web.HTTPError(404)
+
+    def get(self):
+        self.set_header('Content-Type', 'text/plain')
+        self.write(self.profiler.collapsed())
+
+    def post(self):
+        action = self.get_argument('action')
+        if action == 'start':
+            self.profiler.start()
+        elif action == 'stop':
+            self.profiler.stop()
+        elif action == 'reset':
+            self.profiler.reset()
+        else:
+            raise tornado.web.HTTPError(400)
+        self.write('profiler {0}\n'.format(
+            'running' if self.profiler.running else 'stopped'))
+
 class WebSocketHandler(tornado.websocket.WebSocketHandler):
+    # id of the user on this connection, set by BackEnd.add_user
+    userid = None
+    # wire encoding of the messages we send (see message.py)
+    encoding = message.ENC_JSON
+
     def open(self):
 
         if DEBUG:
             print 'OPEN'
 
-        _backend.add_user(self)
+        enc = self.get_argument('enc', message.ENC_JSON)
+        if enc in message.ENCODINGS:
+            self.encoding = enc
+        # we have no user until the client's connect message comes
+        ioloop = tornado.ioloop.IOLoop.instance()
+        self._connect_timeout = ioloop.add_timeout(
+            ioloop.time() + IDLE_TIMEOUT, self.close)
+
+    def _connect(self, mess):
+        """Add the user for the connect message mess.  A client that was
+        connected before asks to resume its session; this is not done
+        with url arguments, which proxies log, since it has the
+        auth_token."""
+
+        tornado.ioloop.IOLoop.instance().remove_timeout(self._connect_timeout)
+        try:
+            msg = json.loads(mess)
+            if msg[message.K_TYPE] != message.M_CONNECT:
+                raise ValueError
+        except (ValueError, TypeError, KeyError):
+            self.close()
+            return
+        try:
+            userid = int(msg[message.K_ID])
+            since = msg.get('since')
+            since = None if since is None else int(since)
+        except (KeyError, TypeError, ValueError):
+            userid = since = None
+        _backend.add_user(self, userid, msg.get(message.K_AUTH), since)
+
+    def get_compression_options(self):
+        """Allow the permessage-deflate extension (Tornado 4.0 and
+        later; older versions never call this)."""
+        return {}
 
     def on_close(self):
 
         if DEBUG:
             print 'CLOSE'
 
-        _backend.remove_user(self)
+        if self.userid is None:
+            # closed before it connected
+            tornado.ioloop.IOLoop.instance().remove_timeout(
+                self._connect_timeout)
+            return
+        _backend.detach_user(self)
         
     def on_message(self, mess):
 
-        _backend.on_message(mess)
+        if self.userid is None:
+            self._connect(mess)
+        else:
+            _backend.on_message(self, mess)
 
 if __name__ == "__main__":
+    tornado.log.enable_pretty_logging()
+
     # path to all static data
     _dirname = os.path.dirname(__file__)
     static_path = os.path.join(_dirname, 'static')
@@ -91,13 +321,52 @@ if __name__ == "__main__":
         (r'/', LobbyHandler),
         (r'/\?\(.*\)', LobbyHandler),
         (r'/qa-(.*)', QaHandler),
+        (r'/topics', TopicsHandler),
+        (r'/search', SearchHandler),
         (r'/static/(.*)', MyStaticFileHandler, {'path': static_path}),
+        (r'/metrics', MetricsHandler),
+        (r'/metrics/profile', ProfileHandler),
         (r'/ws/[\d+]', WebSocketHandler)
     ])
 
-    http_server = tornado.httpserver.HTTPServer(app)
     # PORT is for Heroku deployment
     port = int(os.environ.get("PORT", 9500))
-    http_server.listen(port)
+    sockets = tornado.netutil.bind_sockets(port)
+
+    if NUM_PROCESSES > 1:
+        redis_url = os.environ.get("REDIS_URL")
+        # create (or drop) the db tables once, before the workers start
+        db.message_database().close()
+        # without a Redis server, the extra process runs a bus broker
+        nforks = NUM_PROCESSES if redis_url else NUM_PROCESSES + 1
+        worker = tornado.process.fork_processes(nforks)
+        if worker == NUM_PROCESSES:
+            bus.BusBroker().listen(BUS_PORT, '127.0.0.1')
+            tornado.ioloop.IOLoop.instance().start()
+            sys.exit(0)
+        if redis_url:
+            url = urlparse.urlparse(redis_url)
+            messagebus = bus.RedisBus(url.hostname, url.port or 6379,
+                                      url.password)
+        else:
+            messagebus = bus.RedisBus('127.0.0.1', BUS_PORT)
+        _backend = backend.BackEnd(messagebus, worker, NUM_PROCESSES,
+                                   drop=False)
+    else:
+        _backend = backend.BackEnd()
+
+    http_server = tornado.httpserver.HTTPServer(app)
+    http_server.add_sockets(sockets)
     main_loop = tornado.ioloop.IOLoop.instance()
-    main_loop.start()
+    monitor.LagMonitor(LAG_INTERVAL, main_loop).start()
+
+    # stop cleanly on SIGTERM (which is what Heroku sends)
+    def on_sigterm(signum, frame):
+        main_loop.add_callback_from_signal(main_loop.stop)
+    signal.signal(signal.SIGTERM, on_sigterm)
+
+    try:
+        main_loop.start()
+    finally:
+        # write anything the db still has queued
+        _backend.close()
@@ -1,5 +1,7 @@
 """Settings for the server."""
 
+import os
+
 # print messages received and sent
 DEBUG = False
 
@@ -10,11 +12,124 @@ DATE_FORMAT = '%d %B %Y %H:%M'
 # DB_FILE     - data is stored in flat files
 # DB_POSTGRES - postgreSQL database
 # DB_DUMMY    - fake data store, nothing stored
+# (the QANDA_DB_TYPE environment variable overrides it)
 DB_FILE = 'file'
 DB_POSTGRES = 'postgres'
 DB_DUMMY = 'dummy'
-DB_TYPE = DB_POSTGRES
+DB_TYPE = os.environ.get('QANDA_DB_TYPE', DB_POSTGRES)
 
 # if DB_DROP = True, we will *DELETE* all tables from the DB when we
 # start the server.
 DB_DROP = False
+
+# if True, the flat file db calls fsync after every write, so that no
+# message is lost if the machine crashes (at some cost in speed)
+FILEDB_FSYNC = False
+
+# size of the pool of PostgreSQL connections (can also be set with the
+# PG_POOL_MIN and PG_POOL_MAX environment variables).  A connection that
+# has been idle for PG_POOL_CHECK_INTERVAL seconds is checked before use.
+PG_POOL_MIN = 1
+PG_POOL_MAX = 5
+PG_POOL_CHECK_INTERVAL = 30
+
+# PostgreSQL inserts are committed in batches by a background thread.  A
+# batch is written once it has WRITE_BEHIND_BATCH_SIZE rows, or
+# WRITE_BEHIND_INTERVAL seconds after its first row was queued.
+WRITE_BEHIND_BATCH_SIZE = 500
+WRITE_BEHIND_INTERVAL = 0.2
+# at most this many rows can be waiting to be written; adding a message
+# beyond this blocks until the writer has caught up
+WRITE_BEHIND_MAX_PENDING = 10000
+# a batch that could not be written is retried after
+# WRITE_BEHIND_RETRY_DELAY seconds, and then at doubling intervals of up
+# to WRITE_BEHIND_MAX_RETRY_DELAY seconds; nothing new is written
+# meanwhile, so a db outage fills the queue and then holds up new
+# messages
+WRITE_BEHIND_RETRY_DELAY = 0.5
+WRITE_BEHIND_MAX_RETRY_DELAY = 30
+# reads wait for the rows before them to be written, but give up (and
+# fail) after WRITE_BEHIND_FLUSH_TIMEOUT seconds, rather than hold up
+# the server for as long as the db is down
+WRITE_BEHIND_FLUSH_TIMEOUT = 2
+
+# the messages of a topic are loaded from the db when it is first
+# visited.  Topics that nobody is connected to are unloaded again, least
+# recently used first, once more than MAX_LOADED_TOPICS topics or
+# MAX_LOADED_MESSAGES messages are in memory.
+MAX_LOADED_TOPICS = 100
+MAX_LOADED_MESSAGES = 200000
+# the messages of this many of the newest topics are loaded when the
+# server starts
+PRELOAD_TOPICS = 10
+
+# number of question threads sent to the client at a time
+TREE_PAGE_SIZE = 20
+# how many levels of replies below each question are sent with it (None
+# for all); the client asks for deeper replies when they are expanded
+TREE_PAGE_DEPTH = 3
+# number of threads in the summaries sent by BackEnd.send_top_threads
+TOP_THREADS = 10
+
+# number of topics shown on each page of the lobby
+LOBBY_PAGE_SIZE = 50
+# the most results returned by a search of the messages
+SEARCH_RESULTS = 20
+
+# number of server processes.  With more than one, the processes share
+# topics, messages and users over a message bus: the Redis server given
+# by the REDIS_URL environment variable if there is one, otherwise a
+# broker process (see bus.py) that listens on BUS_PORT.
+NUM_PROCESSES = 1
+BUS_PORT = 9501
+# each process tells the others it is alive every BUS_HEARTBEAT_INTERVAL
+# seconds; the users of a process that has not been heard from in
+# BUS_NODE_TIMEOUT seconds (one that crashed, say) are taken out of the
+# topics
+BUS_HEARTBEAT_INTERVAL = 10
+BUS_NODE_TIMEOUT = 35
+
+# new ids are reserved from the db this many at a time
+ID_BLOCK_SIZE = 100
+
+# with the deflate wire encoding, messages from the server at least
+# this many bytes long are compressed, at this zlib level
+DEFLATE_MIN_SIZE = 512
+DEFLATE_LEVEL = 6
+
+# clients send a heartbeat every HEARTBEAT_INTERVAL seconds (this must
+# match qa.heartBeatT in static/qa.js).  Connections we have not heard
+# from in IDLE_TIMEOUT seconds are closed; we check every REAP_TICK
+# seconds.
+HEARTBEAT_INTERVAL = 10
+IDLE_TIMEOUT = 35
+REAP_TICK = 5
+# when a connection closes, the user stays in its topic for this many
+# seconds, in case the client reconnects and resumes the session
+RESUME_GRACE = 30
+# arrivals and departures in each topic are sent to its users together,
+# every PRESENCE_FLUSH_INTERVAL seconds
+PRESENCE_FLUSH_INTERVAL = 1
+
+# a user that has more than OUTBOUND_HIGH_WATER bytes of messages
+# waiting to be sent for longer than OUTBOUND_GRACE seconds is
+# disconnected
+OUTBOUND_HIGH_WATER = 1024 * 1024
+OUTBOUND_GRACE = 10
+
+# frames from clients longer than this many bytes are dropped
+MAX_FRAME_SIZE = 64 * 1024
+# rate limits, as (frames per second, burst): on all the frames from a
+# user (except heartbeats), and on the messages that are sent on to
+# every user in a topic, by user and by topic.  Frames over the limit
+# are dropped.
+USER_FRAME_LIMIT = (10, 30)
+USER_FANOUT_LIMIT = (1, 5)
+TOPIC_FANOUT_LIMIT = (20, 50)
+
+# how often (in seconds) we measure how late the IOLoop runs callbacks
+LAG_INTERVAL = 1
+# allow the sampling profiler to be controlled at /metrics/profile, and
+# the interval (in seconds of CPU time) between its samples
+PROFILER_ENABLED = False
+PROFILER_INTERVAL = 0.005
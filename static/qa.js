@@ -18,11 +18,13 @@ qa.send = function (message) {
 };
 
 qa.heartBeat = true;   // send regular heartbeats to the server?
-qa.heartBeatT = 10000; // time (in ms) between each heartbeat
+qa.heartBeatT = 10000; // time (in ms) between each heartbeat (see
+                       // HEARTBEAT_INTERVAL in settings.py)
+qa.heartBeatFrame = 'hb'; // sent as is, not as JSON
 
 if (qa.heartBeat) {
     window.setInterval(function () {
-        qa.send({'mtype': 'heartbeat'});
+        ws.send(qa.heartBeatFrame);
     }, qa.heartBeatT);
 }
 
@@ -32,5 +34,35 @@ qa.currentUsers = {};
 // allMessages key is message id, item is the message
 qa.allMessages = {};
 
+// replyIds key is message id, item is the list of ids of the replies
+// to the message that we have
+qa.replyIds = {};
+
+// replies this deep or deeper start off collapsed, and are only drawn
+// when the user expands them (root messages have depth 0)
+qa.collapseDepth = 2;
+
+// the most messages drawn in one animation frame when we draw a page
+// of threads
+qa.renderChunk = 300;
+
 // parent id for 'root' (top level) messages
 qa.rootParentId = -1;
+
+// id of the newest message we have received, sent to the server as
+// 'since' if we join the topic again after reconnecting
+qa.lastMessageId = undefined;
+
+// when we reconnect, ask the server to resume our session
+ws.setResume(function () {
+    if (qa.userId === undefined) {
+        return {};
+    }
+    return {'userid': qa.userId, 'auth_token': qa.authToken,
+            'since': qa.lastMessageId};
+});
+
+// id of the oldest question thread on the page, and whether the server
+// has any older threads for us
+qa.oldestRootId = undefined;
+qa.moreThreads = false;
@@ -11,66 +11,204 @@ qa.callbacks = (function () {
 
     function myhandleCall(resp) {
         qa.page.setMyIdHandle(resp.userid, resp.handle, resp.auth_token);
-        // send back a response to the server with the topic id
-        qa.send({'mtype': 'settopic'});
+        // send back a response to the server with the topic id, and
+        // the last message we saw if we have been here before
+        if (qa.lastMessageId !== undefined) {
+            qa.send({'mtype': 'settopic', 'since': qa.lastMessageId});
+        } else {
+            qa.send({'mtype': 'settopic'});
+        }
     }
 
-    function newhandleCall(resp) {
-        qa.page.addNewHandle(resp.userid, resp.handle);
+    // the server can tell us about the same arrival or departure more
+    // than once (see presence.py), so these do nothing if we already
+    // know
+    function userJoined(id, handle) {
+        var key = id.toString();
+        if (id === qa.userId) {
+            return;
+        }
+        if (qa.currentUsers[key] === undefined) {
+            qa.page.addNewHandle(id, handle);
+        } else if (qa.currentUsers[key] !== handle) {
+            qa.currentUsers[key] = handle;
+            qa.page.changeHandle(id, handle);
+        }
     }
 
-    function addMessageDfs(tree, msg, depth) {
-        var q = [msg];
+    function userLeft(id) {
+        if (qa.currentUsers[id.toString()] !== undefined) {
+            qa.page.removeHandle(id);
+        }
+    }
 
-        while (q.length > 0) {
-            msg = q.shift();
-            // add this particular message to the page
-            qa.page.addmessage(msg, depth);
-            // recursively call this function for all my children
-            tree.children[msg.id].forEach(function (element) {
-                addMessageDfs(tree, tree.messages[element.toString()], depth + 1);
-            });
+    // roster is everyone else in the topic, replacing whoever we had
+    function setRoster(roster) {
+        var present = {};
+        roster.forEach(function (user) {
+            present[user.userid.toString()] = true;
+            userJoined(user.userid, user.handle);
+        });
+        Object.keys(qa.currentUsers).forEach(function (id) {
+            if (!present[id]) {
+                userLeft(id);
+            }
+        });
+    }
+
+    function rosterCall(resp) {
+        setRoster(resp.roster);
+    }
+
+    function presenceCall(resp) {
+        resp.joined.forEach(function (user) {
+            userJoined(user.userid, user.handle);
+        });
+        resp.left.forEach(userLeft);
+    }
+
+    // add a message to the page, unless we already have it or it is
+    // a reply in a thread that we haven't fetched yet (we get it along
+    // with the thread)
+    function addmessage(msg) {
+        if (qa.allMessages[msg.id] === undefined &&
+                (msg.parentid === qa.rootParentId ||
+                 qa.allMessages[msg.parentid] !== undefined)) {
+            qa.page.addmessage(msg);
         }
     }
 
-    // this gets executed only once, when we first visit the page
-    function fulltreeCall(resp) {
-        var i,
-            tree = resp.tree,
-            currId;
-        // populate the page
-        for (i = 0; i !== tree.rootnodes.length; i += 1) {
-            currId = tree.rootnodes[i].toString();
-            // depth first descent
-            addMessageDfs(tree, tree.messages[currId], 0);
+    // store the messages of the thread in tree below rootId that we
+    // don't have yet, parents before children; they are added to the
+    // page one by one if add, otherwise the page is left alone.  The
+    // server leaves out the replies to deep messages (tree.truncated
+    // has how many there are), and we fetch them if they are expanded.
+    function storeThread(tree, rootId, add) {
+        var stack = [rootId],
+            msg,
+            i;
+        while (stack.length > 0) {
+            msg = tree.messages[stack.pop().toString()];
+            if (qa.allMessages[msg.id] === undefined) {
+                if (tree.truncated[msg.id] !== undefined) {
+                    msg.nmissing = tree.truncated[msg.id];
+                }
+                if (add) {
+                    qa.page.addmessage(msg);
+                } else {
+                    qa.page.storeMessage(msg);
+                }
+            }
+            // pushed in reverse, so that replies are stored in order
+            for (i = tree.children[msg.id].length - 1; i >= 0; i -= 1) {
+                stack.push(tree.children[msg.id][i]);
+            }
         }
     }
 
-    function removehandleCall(resp) {
-        qa.page.removeHandle(resp.userid);
+    // we get the newest threads when we first visit the page, then
+    // older threads each time we ask for more
+    function treepageCall(resp) {
+        var tree = resp.tree,
+            older = (resp.before !== null),
+            newRoots = [];
+        // new threads are drawn together, and any new replies in the
+        // threads we have (if we rejoined) are added to them
+        tree.rootnodes.forEach(function (rootId) {
+            if (qa.allMessages[rootId] === undefined) {
+                storeThread(tree, rootId, false);
+                newRoots.push(rootId);
+            } else {
+                storeThread(tree, rootId, true);
+            }
+        });
+        if (!older && tree.last !== null) {
+            qa.lastMessageId = tree.last;
+        }
+        // a newest page when we already have threads (we rejoined, but
+        // the server didn't know our last message) only fills in gaps
+        if (older || qa.oldestRootId === undefined) {
+            if (tree.rootnodes.length > 0) {
+                qa.oldestRootId = tree.rootnodes[0];
+            }
+            qa.moreThreads = tree.more;
+        }
+        // older threads go above the threads we already have; we don't
+        // ask for more until these are drawn
+        qa.page.addThreads(newRoots, older || qa.page.isEmpty(),
+                           function () {
+                qa.page.showMoreThreads(qa.moreThreads);
+            });
+    }
+
+    // received with the replies below a message we expanded
+    function threadtreeCall(resp) {
+        var msg = qa.allMessages[resp.id];
+        if (msg === undefined || !msg.nmissing) {
+            return;
+        }
+        msg.nmissing = 0;
+        storeThread(resp.tree, resp.id, true);
+        qa.page.expand(msg);
+    }
+
+    // received instead of a tree page when we rejoin the topic
+    function missedCall(resp) {
+        resp.messages.forEach(function (msg) {
+            addmessage(msg);
+            qa.lastMessageId = msg.id;
+        });
+    }
+
+    // received instead of myhandle when the server resumes our session
+    // after we reconnect; roster is everyone in the topic now, and
+    // messages is what we missed (null if we are sent a tree page)
+    function resumedCall(resp) {
+        qa.page.setMyIdHandle(resp.userid, resp.handle, resp.auth_token);
+        setRoster(resp.roster);
+        if (resp.messages !== null) {
+            missedCall(resp);
+        }
     }
 
     function newmessageCall(resp) {
-        qa.page.addmessage(resp.message);
+        addmessage(resp.message);
+        qa.lastMessageId = resp.message.id;
+    }
+
+    function searchresultsCall(resp) {
+        qa.page.showSearchResults(resp.query, resp.results);
     }
 
     function changehandleCall(resp) {
-        qa.currentUsers[resp.changeid.toString()] = resp.newhandle;
-        qa.page.changeHandle(resp.changeid, resp.newhandle);
+        // if we haven't heard of the user yet, we get the new handle
+        // when we do
+        if (qa.currentUsers[resp.changeid.toString()] !== undefined) {
+            qa.currentUsers[resp.changeid.toString()] = resp.newhandle;
+            qa.page.changeHandle(resp.changeid, resp.newhandle);
+        }
     }
 
     // callbacks for the different message types that can be received
     // from server.
     var cbacks = {
-        // we receive handle (username) and fulltree on open
+        // we receive handle (username) and the newest threads on open
         'myhandle': myhandleCall,
-        'fulltree': fulltreeCall,
-        // received when a someone new enters the room
-        'newhandle': newhandleCall,
-        // received when someone leaves the room
-        'removehandle': removehandleCall,
+        'treepage': treepageCall,
+        // received instead of treepage when we rejoin a topic
+        'missed': missedCall,
+        // received instead of myhandle when we reconnect in time
+        'resumed': resumedCall,
+        // received when we join a topic, with everyone already there
+        'roster': rosterCall,
+        // received every so often while people enter and leave the room
+        'presence': presenceCall,
         // received when a new message is posted
         'newmessage': newmessageCall,
+        // received with the replies of a message that we expand
+        'threadtree': threadtreeCall,
+        // received with the messages found when we search the topic
+        'searchresults': searchresultsCall,
         // received when *another* client has changed their handle
         'changehandle': changehandleCall
     };
@@ -14,6 +14,13 @@ qa.page = (function () {
         myhandleDiv = document.getElementById("myhandle"),
         addQuestionButton = document.getElementById("addquestion"),
         mymsg = document.getElementById("msgtxt"),
+        questionTree = document.getElementById("questiontree"),
+        moreLink = document.getElementById("morethreads"),
+        searchForm = document.getElementById("searchform"),
+        searchText = document.getElementById("searchtext"),
+        searchResults = document.getElementById("searchresults"),
+        // true while we are waiting for a page of older threads
+        fetchingThreads = false,
         replyid;
 
     // topic id is a hidden element on the page
@@ -66,37 +73,43 @@ qa.page = (function () {
         handleDiv.parentNode.removeChild(handleDiv);
     }
 
-    // draw a message on the HTML document
-    function addmessage(msg) {
-        var pDivId,
-            pDiv,
+    // set the text of the link that expands and collapses the replies
+    // to msg; msg.nmissing is the number of replies the server has
+    // that we haven't fetched yet
+    function setToggle(msg) {
+        var nreplies = qa.replyIds[msg.id].length + (msg.nmissing || 0);
+        if (nreplies === 0) {
+            msg.toggle.innerHTML = '';
+        } else if (msg.fetching) {
+            msg.toggle.innerHTML = '[...] ';
+        } else if (msg.expanded) {
+            msg.toggle.innerHTML = '[-] ';
+        } else {
+            msg.toggle.innerHTML = '[+' + nreplies +
+                (nreplies === 1 ? ' reply] ' : ' replies] ');
+        }
+    }
+
+    // create the div for a message (but don't add it to the document);
+    // the replies to the message go in msg.repliesDiv
+    function messageDiv(msg) {
+        var isRoot = (msg.parentid === qa.rootParentId),
+            parentmsg = isRoot ? {} : qa.allMessages[msg.parentid],
             messageDiv = document.createElement('div'),
             userSpan = document.createElement('span'),
             timeSpan = document.createElement('span'),
             textDiv = document.createElement('div'),
+            toggleLink = document.createElement('a'),
             replySpan = document.createElement('span'),
-            isRoot = (msg.parentid === qa.rootParentId),
-            parentmsg = isRoot ? {} : qa.allMessages[msg.parentid],
-            depth = isRoot ? 0 : parentmsg.depth + 1,
+            repliesDiv = document.createElement('div'),
             divWidth;
 
-        // store the message
-        msg.depth = depth;
-        qa.allMessages[msg.id] = msg;
-
-        // get the parent div
-        if (isRoot) {
-            pDivId = "questiontree";
-        } else {
-            pDivId = "msg" + msg.parentid;
-        }
-        pDiv = document.getElementById(pDivId);
         // the message div
         messageDiv.className = "message not_selected";
         messageDiv.id = "msg" + msg.id;
-        if (depth > 0) {
+        if (msg.depth > 0) {
             messageDiv.style.marginLeft = "80px";
-            divWidth = Math.max(180, 500 - 80 * depth);
+            divWidth = Math.max(180, 500 - 80 * msg.depth);
             messageDiv.style.width = divWidth + "px";
         }
         // user who posted the message
@@ -111,6 +124,16 @@ qa.page = (function () {
         // the actual message text itself
         textDiv.className = "message_text";
         textDiv.innerHTML = msg.message;
+        // expand or collapse the replies
+        toggleLink.className = "message_toggle";
+        toggleLink.href = "javascript:void(0)";
+        toggleLink.onclick = function () {
+            if (msg.expanded) {
+                collapse(msg);
+            } else {
+                expand(msg);
+            }
+        };
         // the reply link
         replySpan.className = "message_reply";
         replySpan.innerHTML = "<a href=javascript:void(0) onclick=qa.page.showReplyDiv(" + msg.id + ");>Reply</a>";
@@ -118,8 +141,245 @@ qa.page = (function () {
         messageDiv.appendChild(userSpan);
         messageDiv.appendChild(timeSpan);
         messageDiv.appendChild(textDiv);
+        messageDiv.appendChild(toggleLink);
         messageDiv.appendChild(replySpan);
-        pDiv.appendChild(messageDiv);
+        messageDiv.appendChild(repliesDiv);
+
+        msg.div = messageDiv;
+        msg.toggle = toggleLink;
+        msg.repliesDiv = repliesDiv;
+        // replies are only drawn once the message is expanded
+        msg.repliesDrawn = false;
+        msg.expanded = (msg.depth + 1 < qa.collapseDepth && !msg.nmissing);
+        setToggle(msg);
+        return messageDiv;
+    }
+
+    // draw the message with id msgid and, below it, the replies of
+    // every expanded message under it; returns the div, and the
+    // number of messages drawn
+    function drawThread(msgid) {
+        var top = qa.allMessages[msgid],
+            div = messageDiv(top),
+            stack = [top],
+            ndrawn = 1,
+            msg,
+            reply,
+            i;
+        while (stack.length > 0) {
+            msg = stack.pop();
+            if (msg.expanded) {
+                for (i = 0; i < qa.replyIds[msg.id].length; i += 1) {
+                    reply = qa.allMessages[qa.replyIds[msg.id][i]];
+                    msg.repliesDiv.appendChild(messageDiv(reply));
+                    stack.push(reply);
+                    ndrawn += 1;
+                }
+                msg.repliesDrawn = true;
+            }
+        }
+        return {'div': div, 'ndrawn': ndrawn};
+    }
+
+    function expand(msg) {
+        var frag, i;
+        if (msg.nmissing) {
+            // we are called again once the replies arrive
+            if (!msg.fetching) {
+                msg.fetching = true;
+                qa.send({'mtype': 'getthread', 'id': msg.id});
+                setToggle(msg);
+            }
+            return;
+        }
+        msg.fetching = false;
+        if (!msg.repliesDrawn) {
+            frag = document.createDocumentFragment();
+            for (i = 0; i < qa.replyIds[msg.id].length; i += 1) {
+                frag.appendChild(drawThread(qa.replyIds[msg.id][i]).div);
+            }
+            msg.repliesDiv.appendChild(frag);
+            msg.repliesDrawn = true;
+        }
+        msg.repliesDiv.style.display = 'block';
+        msg.expanded = true;
+        setToggle(msg);
+    }
+
+    function collapse(msg) {
+        msg.repliesDiv.style.display = 'none';
+        msg.expanded = false;
+        setToggle(msg);
+    }
+
+    // store a message we have received, without drawing it; its
+    // parent must already be stored
+    function storeMessage(msg) {
+        var isRoot = (msg.parentid === qa.rootParentId);
+        msg.depth = isRoot ? 0 : qa.allMessages[msg.parentid].depth + 1;
+        qa.allMessages[msg.id] = msg;
+        qa.replyIds[msg.id] = [];
+        if (!isRoot) {
+            qa.replyIds[msg.parentid].push(msg.id);
+        }
+    }
+
+    // store a message and draw it if it can be seen: a root message is
+    // drawn at the bottom, and a reply if its parent has been expanded.
+    // A reply to a message whose replies we haven't fetched is left to
+    // come with the others.
+    function addmessage(msg) {
+        var parentmsg;
+        if (msg.parentid === qa.rootParentId) {
+            storeMessage(msg);
+            questionTree.appendChild(messageDiv(msg));
+            return;
+        }
+        parentmsg = qa.allMessages[msg.parentid];
+        if (parentmsg.nmissing) {
+            parentmsg.nmissing += 1;
+        } else {
+            storeMessage(msg);
+            if (parentmsg.repliesDrawn) {
+                parentmsg.repliesDiv.appendChild(messageDiv(msg));
+            }
+        }
+        if (parentmsg.toggle !== undefined) {
+            setToggle(parentmsg);
+        }
+    }
+
+    // draw the threads with the (stored) root messages rootIds, oldest
+    // first, above the threads on the page if atTop, otherwise below
+    // them.  A large page would hold up the browser if drawn all at
+    // once, so we draw about qa.renderChunk messages in each animation
+    // frame, and call done() when they are all drawn.
+    function addThreads(rootIds, atTop, done) {
+        var lo = 0,
+            hi = rootIds.length;
+
+        function drawChunk() {
+            var frag = document.createDocumentFragment(),
+                divs = [],
+                ndrawn = 0,
+                thread;
+            while (lo < hi && ndrawn < qa.renderChunk) {
+                // drawing from the top up, we start with the newest
+                if (atTop) {
+                    hi -= 1;
+                    thread = drawThread(rootIds[hi]);
+                } else {
+                    thread = drawThread(rootIds[lo]);
+                    lo += 1;
+                }
+                divs.push(thread.div);
+                ndrawn += thread.ndrawn;
+            }
+            if (atTop) {
+                divs.reverse();
+            }
+            divs.forEach(function (div) {
+                frag.appendChild(div);
+            });
+            questionTree.insertBefore(frag,
+                                      atTop ? questionTree.firstChild : null);
+            if (lo < hi) {
+                window.requestAnimationFrame(drawChunk);
+            } else if (done) {
+                done();
+            }
+        }
+        drawChunk();
+    }
+
+    function isEmpty() {
+        return questionTree.firstElementChild === null;
+    }
+
+    // expand the messages above msgid, and scroll to it
+    function showMessage(msgid) {
+        var path = [],
+            msg = qa.allMessages[msgid];
+        if (msg === undefined) {
+            return;
+        }
+        while (msg.parentid !== qa.rootParentId) {
+            msg = qa.allMessages[msg.parentid];
+            path.push(msg);
+        }
+        // the root message has not been drawn yet
+        if (msg.div === undefined) {
+            return;
+        }
+        path.reverse().forEach(function (m) {
+            if (!m.expanded) {
+                expand(m);
+            }
+        });
+        qa.allMessages[msgid].div.scrollIntoView();
+    }
+
+    // ask the server for the threads older than those on the page
+    function fetchMoreThreads() {
+        if (qa.moreThreads && !fetchingThreads) {
+            fetchingThreads = true;
+            qa.send({'mtype': 'moretree', 'before': qa.oldestRootId});
+        }
+    }
+
+    function showMoreThreads(show) {
+        fetchingThreads = false;
+        moreLink.style.display = show ? 'block' : 'none';
+    }
+
+    moreLink.onclick = fetchMoreThreads;
+    // fetch older threads when the user scrolls up to the top
+    window.onscroll = function () {
+        if (moreLink.getBoundingClientRect().bottom >= 0 &&
+                moreLink.getBoundingClientRect().top <= window.innerHeight) {
+            fetchMoreThreads();
+        }
+    };
+
+    searchForm.onsubmit = function () {
+        if (searchText.value.trim() !== '') {
+            qa.send({'mtype': 'search', 'query': searchText.value});
+        }
+        return false; // don't refresh page
+    };
+
+    // list the messages found by a search, each below the messages
+    // above it in its thread; clicking one shows it in the tree if it
+    // is on the page
+    function showSearchResults(query, results) {
+        var header = document.createElement('div');
+        searchResults.innerHTML = '';
+        header.className = 'message_time';
+        header.textContent = results.length + ' results for "' + query + '"';
+        searchResults.appendChild(header);
+        results.forEach(function (result) {
+            var resultDiv = document.createElement('div'),
+                threadDiv = document.createElement('div'),
+                userSpan = document.createElement('span'),
+                textDiv = document.createElement('div'),
+                msg = result.message;
+            resultDiv.className = 'search_result';
+            threadDiv.className = 'search_thread';
+            threadDiv.textContent = result.thread.map(function (m) {
+                return m.user + ': ' + m.message;
+            }).join(' > ');
+            userSpan.className = 'message_user';
+            userSpan.textContent = msg.user + ' ' + msg.posttime;
+            textDiv.className = 'message_text';
+            textDiv.textContent = msg.message;
+            resultDiv.appendChild(threadDiv);
+            resultDiv.appendChild(userSpan);
+            resultDiv.appendChild(textDiv);
+            resultDiv.onclick = function () {
+                showMessage(msg.id);
+            };
+            searchResults.appendChild(resultDiv);
+        });
     }
 
     function showReplyDiv(msgid) {
@@ -154,9 +414,13 @@ qa.page = (function () {
     sendform.onsubmit = function () {
         var txt = mymsg.value,
             msg = {'mtype': 'response', 'text': txt, 'replyid': replyid};
-        // set the parent div to not_selected
+        // set the parent div to not_selected, and make sure our reply
+        // will be seen
         if (replyid !== qa.rootParentId) {
             document.getElementById("msg" + replyid).className = "message not_selected";
+            if (!qa.allMessages[replyid].expanded) {
+                expand(qa.allMessages[replyid]);
+            }
         }
         qa.send(msg);
         mymsg.value = '';
@@ -170,6 +434,12 @@ qa.page = (function () {
             'addNewHandle': addNewHandle,
             'removeHandle': removeHandle,
             'changeHandle': changeHandle,
+            'storeMessage': storeMessage,
             'addmessage': addmessage,
+            'addThreads': addThreads,
+            'expand': expand,
+            'isEmpty': isEmpty,
+            'showMoreThreads': showMoreThreads,
+            'showSearchResults': showSearchResults,
             'showReplyDiv': showReplyDiv};
 }());
@@ -5,43 +5,122 @@
 // All received messages should have "mtype" as a key.  Each arriving message
 // is passed to a callback function according to its mtype; the
 // callback function can be set by calling the function ws.setCallBacks
+// The server can send messages with short keys, and compress the large
+// ones into binary frames (see message.py); we ask for this with the
+// 'enc' argument of the websocket url.
+// The first message on each connection is a 'connect' message, with the
+// keys from the function set by ws.setResume, so that the server can
+// resume our session (they are not put in the url, which proxies log).
+// If the connection drops we connect again, waiting longer after each
+// failed attempt.
 
 'use strict';
 /*jslint browser:true */
-/*global WebSocket */
+/*global WebSocket, DecompressionStream, Response, Blob, Promise */
 
 // note that ws lives in the global namespace
 var ws = (function () {
 
     // configuation options
-    var wsUri = location.origin.replace(/^http/, 'ws') + '/ws/' + document.getElementById('topicid').innerHTML,
+    var encoding = (window.DecompressionStream ? 'deflate' : 'compact'),
+        wsUri = location.origin.replace(/^http/, 'ws') + '/ws/' + document.getElementById('topicid').innerHTML + '?enc=' + encoding,
+        // wait between reconnection attempts, in ms, doubled after each
+        // failed attempt up to the maximum (plus up to half as much
+        // again at random, so that clients dropped together don't all
+        // come back together)
+        reconnectDelay = 1000,
+        maxReconnectDelay = 30000,
+        attempts = 0,
+        resumeArgs = function () { return {}; },
         simLatency = 0,  // simulated latency (one way trip time) in ms
         debug = true,    // print messages sent and received to console
         dummy = false,   // if dummy, no messages sent/received
+        // full versions of the short keys (must match SHORT_KEYS in
+        // message.py)
+        longKeys = {t: 'mtype', u: 'userid', a: 'auth_token', ts: 'tstamp',
+                    h: 'handle', c: 'changeid', nh: 'newhandle',
+                    tr: 'tree', b: 'before', m: 'message', ms: 'messages',
+                    rn: 'rootnodes', ch: 'children', mo: 'more', l: 'last',
+                    us: 'user', i: 'id', p: 'parentid', pt: 'posttime',
+                    o: 'topicid', ro: 'roster', jo: 'joined', le: 'left',
+                    qu: 'query', rs: 'results', th: 'thread',
+                    tc: 'truncated', ths: 'threads', r: 'replies',
+                    la: 'lastactivity'},
+        // binary frames are decompressed asynchronously, so while any
+        // are being decompressed, later messages wait their turn here
+        decoding = null,
+        ndecoding = 0,
         callbacks,
         webSocket;
 
-    function onMessageFunction(evt) {
+    // return obj with the short keys replaced by the full keys
+    function expandKeys(obj) {
+        var out, key, i;
+        if (obj === null || typeof obj !== 'object') {
+            return obj;
+        }
+        if (Array.isArray(obj)) {
+            out = [];
+            for (i = 0; i < obj.length; i += 1) {
+                out.push(expandKeys(obj[i]));
+            }
+            return out;
+        }
+        out = {};
+        for (key in obj) {
+            if (obj.hasOwnProperty(key)) {
+                out[longKeys[key] || key] = expandKeys(obj[key]);
+            }
+        }
+        return out;
+    }
+
+    // text is the JSON of a received message
+    function dispatch(text) {
         var resp;
         if (debug) {
-            console.log("received message: " + evt.data);
-        }
-        if (dummy) {
-            return;
+            console.log("received message: " + text);
         }
 
-        // message received should be JSON
-        resp = JSON.parse(evt.data);
+        resp = JSON.parse(text);
+        if (encoding !== 'json') {
+            resp = expandKeys(resp);
+        }
 
         // call callback function from lookup table
         callbacks[resp.mtype](resp);
     }
 
+    // return a promise of the text in the compressed ArrayBuffer buf
+    function inflate(buf) {
+        var stream = new Blob([buf]).stream()
+            .pipeThrough(new DecompressionStream('deflate'));
+        return new Response(stream).text();
+    }
+
+    function onMessageFunction(evt) {
+        if (dummy) {
+            return;
+        }
+
+        if (typeof evt.data === 'string' && ndecoding === 0) {
+            dispatch(evt.data);
+            return;
+        }
+        ndecoding += 1;
+        decoding = (decoding || Promise.resolve()).then(function () {
+            return (typeof evt.data === 'string') ? evt.data : inflate(evt.data);
+        }).then(function (text) {
+            ndecoding -= 1;
+            dispatch(text);
+        });
+    }
+
     function sendFunction(msg) {
         if (debug) {
             console.log("sending message: " + msg);
         }
-        if (dummy) {
+        if (dummy || webSocket.readyState !== WebSocket.OPEN) {
             return;
         }
         webSocket.send(msg);
@@ -56,12 +135,18 @@ var ws = (function () {
 
     // called when websockset connection opened
     function onopen() {
-        return;
+        var msg = resumeArgs();
+        attempts = 0;
+        msg.mtype = 'connect';
+        sendFunction(JSON.stringify(msg));
     }
 
     // called when websockset connection closed
     function onclose() {
-        return;
+        var delay = Math.min(maxReconnectDelay,
+                             reconnectDelay * Math.pow(2, attempts));
+        attempts += 1;
+        window.setTimeout(init, delay * (1 + Math.random() / 2));
     }
 
     function onerror() {
@@ -74,6 +159,11 @@ var ws = (function () {
         callbacks = cbacks;
     }
 
+    // fn returns an object of the keys to send in the connect message
+    function setResume(fn) {
+        resumeArgs = fn;
+    }
+
     // send a message from the client to the server
     function send(msg) {
         window.setTimeout(function () {
@@ -84,6 +174,7 @@ var ws = (function () {
     // web socket setup
     function init() {
         webSocket = new WebSocket(wsUri);
+        webSocket.binaryType = 'arraybuffer';
         webSocket.onopen = onopen;
         webSocket.onclose = onclose;
         webSocket.onmessage = onmessage;
@@ -93,5 +184,6 @@ var ws = (function () {
     // public API
     return {init: init,
             setCallBacks : setCallBacks,
+            setResume: setResume,
             send: send};
 }());
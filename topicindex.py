@@ -0,0 +1,123 @@
+"""Index of the topics, for searching and paging through them.
+
+Topics can be found by the start of their name (using a sorted list of
+names) or by any part of it (using the trigrams, i.e. the three letter
+substrings, of the names), and sorted by how new they are, how recently
+someone posted in them, how many users they have, or how many messages.
+The index is updated as topics are added and messages posted, rather
+than built for each search.
+"""
+
+import heapq
+from bisect import bisect_left, insort
+
+# ways of matching the query against topic names
+MATCH_PREFIX = 'prefix'
+MATCH_SUBSTRING = 'substring'
+MATCHES = [MATCH_PREFIX, MATCH_SUBSTRING]
+
+# orders of the results, largest first
+SORT_NEW = 'new'            # newest topic
+SORT_RECENT = 'recent'      # most recent message
+SORT_USERS = 'users'        # most users connected
+SORT_MESSAGES = 'messages'  # most messages
+SORTS = [SORT_NEW, SORT_RECENT, SORT_USERS, SORT_MESSAGES]
+
+
+def trigrams(name):
+    return set(name[i:i + 3] for i in xrange(len(name) - 2))
+
+
+class TopicIndex(object):
+
+    def __init__(self):
+        # topicid -> Topic
+        self._topics = {}
+        # (lowercase name, topicid) pairs, sorted
+        self._names = []
+        # trigram -> set of ids of the topics whose names contain it
+        self._trigrams = {}
+        # all topic ids, sorted
+        self._ids = []
+        # topicid -> number of messages
+        self._nmessages = {}
+        # topicid -> when the last message was posted, in seconds since
+        # the epoch (0 for none)
+        self._activity = {}
+
+    def __len__(self):
+        return len(self._topics)
+
+    def add(self, topic, nmessages=0, last_post=0):
+        if topic.id in self._topics:
+            return
+        self._topics[topic.id] = topic
+        name = topic.name.lower()
+        insort(self._names, (name, topic.id))
+        for trigram in trigrams(name):
+            self._trigrams.setdefault(trigram, set()).add(topic.id)
+        insort(self._ids, topic.id)
+        self._nmessages[topic.id] = nmessages
+        self._activity[topic.id] = last_post
+
+    def message_added(self, topicid, timestamp):
+        if topicid in self._topics:
+            self._nmessages[topicid] += 1
+            self._activity[topicid] = max(self._activity[topicid], timestamp)
+
+    def nmessages(self, topicid):
+        return self._nmessages.get(topicid, 0)
+
+    def search(self, query='', match=MATCH_PREFIX, sort=SORT_NEW,
+               offset=0, limit=50):
+        """Return (total, topics): the number of topics whose names
+        match query, and the page of them from offset, in sort order."""
+
+        query = query.lower()
+        if not query:
+            if sort == SORT_NEW:
+                # the common case needs no sorting at all
+                total = len(self._ids)
+                end = max(0, total - offset)
+                ids = self._ids[max(0, end - limit):end][::-1]
+                return (total, [self._topics[tid] for tid in ids])
+            ids = self._ids
+        elif match == MATCH_SUBSTRING:
+            ids = self._find_substring(query)
+        else:
+            ids = self._find_prefix(query)
+
+        key = self._sort_key(sort)
+        page = heapq.nlargest(offset + limit, ids, key=key)[offset:]
+        return (len(ids), [self._topics[tid] for tid in page])
+
+    def _find_prefix(self, query):
+        ids = []
+        i = bisect_left(self._names, (query,))
+        while i < len(self._names) and self._names[i][0].startswith(query):
+            ids.append(self._names[i][1])
+            i += 1
+        return ids
+
+    def _find_substring(self, query):
+        if len(query) < 3:
+            # too short to have a trigram
+            candidates = self._topics
+        else:
+            sets = sorted((self._trigrams.get(t, set())
+                           for t in trigrams(query)), key=len)
+            candidates = set.intersection(*sets)
+        # names that have all the trigrams may still not contain query
+        return [tid for tid in candidates
+                if query in self._topics[tid].name.lower()]
+
+    def _sort_key(self, sort):
+        if sort == SORT_RECENT:
+            return lambda tid: (self._activity[tid], tid)
+        elif sort == SORT_USERS:
+            topics = self._topics
+            return lambda tid: (topics[tid].nusers +
+                                len(topics[tid].remote_users), tid)
+        elif sort == SORT_MESSAGES:
+            return lambda tid: (self._nmessages[tid], tid)
+        return None